@@ -0,0 +1,368 @@
+"""
+Interpreter throughput benchmark.
+
+Runs a fixed set of workloads through RV64Hart: synthetic loops and a few
+ISA tests. For each one it reports MIPS, ns per instruction and, with
+--profile, ns per instruction for each opcode class. Results can be saved
+as a json baseline and compared against it later, e.g.
+
+    python benchmark.py
+    python benchmark.py --mode blocks -n 500000
+    python benchmark.py --save-baseline baseline.json
+    python benchmark.py --baseline baseline.json --threshold 0.1
+"""
+import argparse
+import json
+import logging
+import platform
+import resource
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+from cpu_enums import Ext, Ops
+from devices import MemoryDevice
+from elf_loader import ElfFile
+from htif import HtifDevice
+from system_interface import SystemInterface
+from main import RV64Hart
+
+RAM_BASE = 0x8000_0000
+RAM_SIZE = 0x10000
+
+TESTS_DIR = Path(__file__).parent/"tests"/"rv64"/"elf"/"p"
+# short ISA tests that stop through HTIF, run back to back
+ISA_TESTS = ["rv64ui-p-add", "rv64ui-p-addi", "rv64ui-p-beq", "rv64ui-p-jal",
+    "rv64ui-p-lw", "rv64ui-p-sd", "rv64ui-p-sll", "rv64ui-p-sra",
+    "rv64ui-p-xor", "rv64mi-p-mcsr"]
+
+# ------------------------------- ENCODERS ----------------------------------- #
+
+def enc_r(op, f3, f7, rd, rs1, rs2):
+    return (f7<<25)|(rs2<<20)|(rs1<<15)|(f3<<12)|(rd<<7)|op
+
+def enc_i(op, f3, rd, rs1, imm):
+    return ((imm&0xfff)<<20)|(rs1<<15)|(f3<<12)|(rd<<7)|op
+
+def enc_s(op, f3, rs1, rs2, imm):
+    return (((imm>>5)&0x7f)<<25)|(rs2<<20)|(rs1<<15)|(f3<<12)\
+        |((imm&0x1f)<<7)|op
+
+def enc_b(f3, rs1, rs2, imm):
+    imm &= 0x1fff
+    return (((imm>>12)&1)<<31)|(((imm>>5)&0x3f)<<25)|(rs2<<20)|(rs1<<15)\
+        |(f3<<12)|(((imm>>1)&0xf)<<8)|(((imm>>11)&1)<<7)|0b1100011
+
+def enc_u(op, rd, imm):
+    return ((imm&0xfffff)<<12)|(rd<<7)|op
+
+def addi(rd, rs1, imm): return enc_i(0b0010011, 0b000, rd, rs1, imm)
+def slli(rd, rs1, sh):  return enc_i(0b0010011, 0b001, rd, rs1, sh)
+def add(rd, rs1, rs2):  return enc_r(0b0110011, 0b000, 0, rd, rs1, rs2)
+def sub(rd, rs1, rs2):  return enc_r(0b0110011, 0b000, 0b0100000, rd, rs1, rs2)
+def xor(rd, rs1, rs2):  return enc_r(0b0110011, 0b100, 0, rd, rs1, rs2)
+def addw(rd, rs1, rs2): return enc_r(0b0111011, 0b000, 0, rd, rs1, rs2)
+def mul(rd, rs1, rs2):  return enc_r(0b0110011, 0b000, 1, rd, rs1, rs2)
+def mulh(rd, rs1, rs2): return enc_r(0b0110011, 0b001, 1, rd, rs1, rs2)
+def mulhu(rd, rs1, rs2): return enc_r(0b0110011, 0b011, 1, rd, rs1, rs2)
+def div(rd, rs1, rs2):  return enc_r(0b0110011, 0b100, 1, rd, rs1, rs2)
+def remu(rd, rs1, rs2): return enc_r(0b0110011, 0b111, 1, rd, rs1, rs2)
+def mulw(rd, rs1, rs2): return enc_r(0b0111011, 0b000, 1, rd, rs1, rs2)
+def divw(rd, rs1, rs2): return enc_r(0b0111011, 0b100, 1, rd, rs1, rs2)
+def amo(f5, rd, rs1, rs2, f3=0b011):
+    return enc_r(0b0101111, f3, f5<<2, rd, rs1, rs2)
+def amoswap_w(rd, rs1, rs2): return amo(0b00001, rd, rs1, rs2, 0b010)
+def amoadd_d(rd, rs1, rs2): return amo(0b00000, rd, rs1, rs2)
+def lr_d(rd, rs1):      return amo(0b00010, rd, rs1, 0)
+def sc_d(rd, rs1, rs2): return amo(0b00011, rd, rs1, rs2)
+def sh2add(rd, rs1, rs2): return enc_r(0b0110011, 0b100, 0b0010000, rd, rs1, rs2)
+def andn(rd, rs1, rs2):   return enc_r(0b0110011, 0b111, 0b0100000, rd, rs1, rs2)
+def max_(rd, rs1, rs2):   return enc_r(0b0110011, 0b110, 0b0000101, rd, rs1, rs2)
+def clmul(rd, rs1, rs2):  return enc_r(0b0110011, 0b001, 0b0000101, rd, rs1, rs2)
+def clz(rd, rs1):         return enc_i(0b0010011, 0b001, rd, rs1, 0x600)
+def cpop(rd, rs1):        return enc_i(0b0010011, 0b001, rd, rs1, 0x602)
+def rev8(rd, rs1):        return enc_i(0b0010011, 0b101, rd, rs1, 0x6b8)
+def rori(rd, rs1, sh):    return enc_i(0b0010011, 0b101, rd, rs1, 0x600|sh)
+def bseti(rd, rs1, sh):   return enc_i(0b0010011, 0b001, rd, rs1, 0x280|sh)
+def fp_op(f5, rd, rs1, rs2, fmt=1, rm=0b111):
+    return enc_r(0b1010011, rm, f5<<2|fmt, rd, rs1, rs2)
+def fadd_d(rd, rs1, rs2): return fp_op(0b00000, rd, rs1, rs2)
+def fmul_d(rd, rs1, rs2): return fp_op(0b00010, rd, rs1, rs2)
+def fdiv_d(rd, rs1, rs2): return fp_op(0b00011, rd, rs1, rs2)
+def fsqrt_d(rd, rs1):     return fp_op(0b01011, rd, rs1, 0)
+def fcvt_s_d(rd, rs1):    return fp_op(0b01000, rd, rs1, 1, fmt=0)
+def fadd_s(rd, rs1, rs2): return fp_op(0b00000, rd, rs1, rs2, fmt=0)
+def fcvt_d_l(rd, rs1):    return fp_op(0b11010, rd, rs1, 2)
+def fcvt_l_d(rd, rs1):    return fp_op(0b11000, rd, rs1, 2, rm=0b001)
+def fmadd_d(rd, rs1, rs2, rs3):
+    return enc_r(0b1000011, 0b111, rs3<<2|1, rd, rs1, rs2)
+def ld(rd, rs1, imm):   return enc_i(0b0000011, 0b011, rd, rs1, imm)
+def lw(rd, rs1, imm):   return enc_i(0b0000011, 0b010, rd, rs1, imm)
+def lbu(rd, rs1, imm):  return enc_i(0b0000011, 0b100, rd, rs1, imm)
+def sd(rs2, rs1, imm):  return enc_s(0b0100011, 0b011, rs1, rs2, imm)
+def sw(rs2, rs1, imm):  return enc_s(0b0100011, 0b010, rs1, rs2, imm)
+def sb(rs2, rs1, imm):  return enc_s(0b0100011, 0b000, rs1, rs2, imm)
+def beq(rs1, rs2, imm): return enc_b(0b000, rs1, rs2, imm)
+def bne(rs1, rs2, imm): return enc_b(0b001, rs1, rs2, imm)
+def blt(rs1, rs2, imm): return enc_b(0b100, rs1, rs2, imm)
+def lui(rd, imm):       return enc_u(0b0110111, rd, imm)
+def auipc(rd, imm):     return enc_u(0b0010111, rd, imm)
+def csrrw(rd, csr, rs1): return enc_i(0b1110011, 0b001, rd, rs1, csr)
+def csrrs(rd, csr, rs1): return enc_i(0b1110011, 0b010, rd, rs1, csr)
+def csrrc(rd, csr, rs1): return enc_i(0b1110011, 0b011, rd, rs1, csr)
+def jal_self():         return 0b1101111
+
+MSCRATCH = 0x340
+MSTATUS = 0x300
+
+def loop(body: List[int], count: int) -> List[int]:
+    """`count` iterations of body, x1 is the loop counter and x3 the limit"""
+    head = [lui(3, (count+0x800)>>12), addi(3, 3, count&0xfff), addi(1, 0, 0)]
+    body = body + [addi(1, 1, 1)]
+    return head + body + [bne(1, 3, -4*len(body)), jal_self()]
+
+# ------------------------------- WORKLOADS ---------------------------------- #
+
+def wl_alu(count):
+    return loop([add(2, 2, 1), xor(4, 4, 2), slli(5, 4, 3), sub(6, 5, 1),
+        addw(7, 6, 2), add(8, 8, 7)], count)
+
+def wl_muldiv(count):
+    # same shape as wl_alu with the M extension, x2 grows to full 64 bit
+    # (and negative) values so the signed paths are exercised
+    return [addi(9, 0, -7), addi(2, 0, 3)] + loop([mul(2, 2, 9), mulh(4, 2, 1),
+        mulhu(5, 2, 9), div(6, 2, 9), remu(7, 2, 1), mulw(8, 7, 2),
+        divw(8, 8, 9)], count)
+
+def wl_load_store(count):
+    # x10 points to a scratch area 16KiB after the code
+    return [auipc(10, 4)] + loop([ld(11, 10, 0), addi(11, 11, 1), sd(11, 10, 0),
+        lw(12, 10, 8), sw(12, 10, 12), lbu(13, 10, 16), sb(13, 10, 17)], count)
+
+def wl_atomic(count):
+    # spinlock acquire/release around a counter, then an LR/SC increment
+    return [auipc(10, 4), addi(9, 0, 1)] + loop([amoswap_w(11, 10, 9),
+        amoadd_d(0, 10, 9), sw(0, 10, 0), lr_d(12, 10), addi(12, 12, 1),
+        sc_d(13, 10, 12)], count)
+
+def wl_fp(count):
+    # FS on, f1=1.0, f2=3.0, f6=7.0, then double arithmetic on the counter
+    # with inexact results, one single precision add and a conversion back
+    init = [lui(9, 0x2), csrrs(0, MSTATUS, 9), addi(9, 0, 1), fcvt_d_l(1, 9),
+        addi(9, 0, 3), fcvt_d_l(2, 9), addi(9, 0, 7), fcvt_d_l(6, 9)]
+    return init + loop([fcvt_d_l(3, 1), fmul_d(4, 3, 2), fdiv_d(5, 4, 6),
+        fadd_d(7, 7, 5), fmadd_d(8, 5, 2, 1), fsqrt_d(9, 4), fcvt_s_d(10, 9),
+        fadd_s(11, 11, 10), fcvt_l_d(12, 8)], count)
+
+def wl_bitmanip(count):
+    # Zba/Zbb/Zbc/Zbs on a value scrambled every iteration
+    return [addi(2, 0, 0x5a5)] + loop([sh2add(4, 1, 2), andn(5, 4, 1),
+        rori(2, 4, 13), cpop(6, 2), clz(7, 5), rev8(8, 2), max_(9, 8, 2),
+        bseti(10, 6, 40), clmul(11, 2, 1)], count)
+
+def wl_branch(count):
+    # mix of taken and not taken branches
+    return loop([beq(1, 3, 8), addi(2, 2, 1), blt(3, 1, 8), addi(4, 4, 1),
+        bne(0, 0, 8), addi(5, 5, 1)], count)
+
+def wl_csr(count):
+    return loop([csrrw(2, MSCRATCH, 1), csrrs(4, MSCRATCH, 0),
+        csrrs(5, MSTATUS, 0), csrrc(0, MSCRATCH, 4), add(6, 6, 4)], count)
+
+WORKLOADS : Dict[str, Callable[[int], List[int]]] = {
+    "alu" : wl_alu,
+    "muldiv" : wl_muldiv,
+    "load_store" : wl_load_store,
+    "branch" : wl_branch,
+    "atomic" : wl_atomic,
+    "fp" : wl_fp,
+    "bitmanip" : wl_bitmanip,
+    "csr" : wl_csr,
+}
+
+# ---------------------------------------------------------------------------- #
+
+def make_hart(program: List[int]) -> RV64Hart:
+    ram = MemoryDevice(RAM_SIZE, "RAM")
+    for i, ins in enumerate(program):
+        ram.write(4*i, ins, 4)
+    sys_bus = SystemInterface()
+    sys_bus.register_device(ram, RAM_BASE)
+    return RV64Hart(0, sys_bus, [Ext.A, Ext.B, Ext.F, Ext.D, Ext.S, Ext.U], 
+        entry_point=RAM_BASE)
+
+def make_test_hart(name: str) -> RV64Hart:
+    elf = ElfFile(TESTS_DIR/name)
+    sys_bus = SystemInterface()
+    sys_bus.register_device(MemoryDevice(RAM_SIZE, "RAM"), RAM_BASE)
+    sys_bus.register_device(HtifDevice(sys_bus, elf.fromhost-elf.tohost), 
+        elf.tohost, overlay=True)
+    elf.load(sys_bus)
+    return RV64Hart(0, sys_bus, [Ext.S, Ext.U], entry_point=elf.entry)
+
+def op_class(op: int) -> str:
+    try:
+        return Ops(op).name
+    except ValueError:
+        return "ILLEGAL"
+
+def run_hart(hart: RV64Hart, n_ins: int, mode: str,
+        profile: Dict[str, List[int]] = None) -> Tuple[int, float]:
+    """run up to n_ins instructions, returns (instret, elapsed seconds)"""
+
+    if profile is not None:
+        # time every single step and charge it to the opcode class
+        clock = time.perf_counter_ns
+        instret = 0
+        start = clock()
+        while instret < n_ins:
+            d = hart.decode_cache.get(hart.pc)
+            if d is None:
+                d = hart.fetch_decode(hart.pc)
+            t0 = clock()
+            running = hart.step()
+            t1 = clock()
+            slot = profile.setdefault(op_class(d.op), [0, 0])
+            slot[0] += 1
+            slot[1] += t1-t0
+            instret += 1
+            if not running:
+                break
+        return instret, (clock()-start)/1e9
+
+    start = time.perf_counter()
+    if mode == "blocks":
+        instret = hart.run_blocks(n_ins)
+    else:
+        instret = 0
+        step = hart.step
+        while instret < n_ins and step():
+            instret += 1
+    return instret, time.perf_counter()-start
+
+def run_workload(name: str, n_ins: int, mode: str = "step",
+        profile: Dict[str, List[int]] = None):
+    if name == "isa":
+        # back to back runs of the ISA tests until n_ins is reached, the
+        # hart setup is not timed
+        instret, elapsed = 0, 0.0
+        while instret < n_ins:
+            for test in ISA_TESTS:
+                hart = make_test_hart(test)
+                n, t = run_hart(hart, n_ins-instret, mode, profile)
+                instret += n
+                elapsed += t
+                if instret >= n_ins:
+                    break
+        return instret, elapsed
+
+    # roughly n_ins instructions, the loop bodies are 6-9 instructions long
+    hart = make_hart(WORKLOADS[name](max(1, n_ins//8)))
+    return run_hart(hart, n_ins, mode, profile)
+
+def timer_overhead_ns() -> float:
+    """cost of the two clock reads around a step in profile mode"""
+    clock = time.perf_counter_ns
+    n = 100_000
+    start = clock()
+    for _ in range(n):
+        clock()
+        clock()
+    return (clock()-start)/n
+
+def peak_rss_mb() -> float:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return rss/(1<<20) if sys.platform == "darwin" else rss/(1<<10)
+
+# ---------------------------------------------------------------------------- #
+
+def compare(results: Dict, baseline: Dict, threshold: float) -> List[str]:
+    """workloads whose ns/ins grew more than threshold over the baseline"""
+    regressions = []
+    for name, res in results["workloads"].items():
+        base = baseline["workloads"].get(name)
+        if base is None or base["mode"] != res["mode"]:
+            continue
+        ratio = res["ns_per_ins"]/base["ns_per_ins"]
+        if ratio > 1+threshold:
+            regressions.append(f"{name}: {base['ns_per_ins']:.0f} -> "\
+                f"{res['ns_per_ins']:.0f} ns/ins (+{(ratio-1)*100:.0f}%)")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", "--n-ins", type=int, default=200_000,
+        help="instructions per workload")
+    parser.add_argument("--mode", choices=["step", "blocks"], default="step")
+    parser.add_argument("--repeat", type=int, default=1,
+        help="runs per workload, the fastest one is reported")
+    parser.add_argument("--profile", action="store_true",
+        help="ns/ins by opcode class (step mode, slower)")
+    parser.add_argument("--save-baseline", metavar="FILE",
+        help="write the results as json baseline")
+    parser.add_argument("--baseline", metavar="FILE",
+        help="compare against a json baseline, exit 1 on regression")
+    parser.add_argument("--threshold", type=float, default=0.10,
+        help="allowed slowdown over the baseline (default 0.10)")
+    parser.add_argument("workloads", nargs="*", default=list(WORKLOADS)+["isa"])
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+
+    results = {
+        "python" : platform.python_version(),
+        "machine" : platform.machine(),
+        "n_ins" : args.n_ins,
+        "workloads" : {},
+    }
+
+    print(f"{'workload':<12s} {'instret':>10s} {'time':>8s} {'MIPS':>8s} "\
+        f"{'ns/ins':>8s}")
+    for name in args.workloads:
+        instret, elapsed = min((run_workload(name, args.n_ins, args.mode)
+            for _ in range(args.repeat)), key=lambda r: r[1]/max(r[0], 1))
+        results["workloads"][name] = {
+            "mode" : args.mode,
+            "instret" : instret,
+            "time" : elapsed,
+            "mips" : instret/elapsed/1e6,
+            "ns_per_ins" : elapsed/instret*1e9,
+        }
+        print(f"{name:<12s} {instret:>10d} {elapsed:>7.2f}s "\
+            f"{instret/elapsed/1e6:>8.3f} {elapsed/instret*1e9:>8.0f}")
+
+    if args.profile:
+        profile : Dict[str, List[int]] = {}
+        for name in args.workloads:
+            run_workload(name, args.n_ins, "step", profile)
+        overhead = timer_overhead_ns()
+        results["profile"] = {cls: (ns/n)-overhead
+            for cls, (n, ns) in profile.items()}
+        print(f"\n{'class':<12s} {'count':>10s} {'ns/ins':>8s}"\
+            f"   (timer overhead {overhead:.0f} ns removed)")
+        for cls, (n, ns) in sorted(profile.items(), key=lambda p: -p[1][0]):
+            print(f"{cls:<12s} {n:>10d} {ns/n-overhead:>8.0f}")
+
+    results["peak_rss_mb"] = peak_rss_mb()
+    print(f"\npeak RSS {results['peak_rss_mb']:.1f} MiB")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\nregressions over {args.baseline}:")
+            print(*regressions, sep="\n")
+            return 1
+        print(f"\nno regression over {args.baseline}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
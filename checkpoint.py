@@ -0,0 +1,122 @@
+"""
+Checkpoint and restore of a whole machine: harts, CSRs and every device 
+registered on a SystemInterface. A machine is fast-forwarded once, saved,
+and every later experiment restores it instead of booting again, e.g.
+
+    save_checkpoint("boot.ckpt", sys_bus, [hart])
+    ...
+    load_checkpoint("boot.ckpt", sys_bus, [hart])
+
+The file only holds state, it is restored into a machine built the same
+way (same devices at the same addresses, same harts). Layout:
+
+    MAGIC | header length (u32) | zlib(json header) | page blobs
+
+Device memory is stored as 4KiB pages: all zero pages are dropped, the
+others are deduplicated by content and zlib compressed one by one. The 
+header has the hart states, the device list with their get_state() and a
+page number -> blob index table per device.
+"""
+import json
+import logging
+import zlib
+from hashlib import blake2b
+from struct import Struct
+from typing import Dict, List
+
+from cpu_enums import Mode
+from main import HartState, RV64Hart
+from system_interface import SystemInterface
+
+log = logging.getLogger(__name__)
+
+MAGIC = b"RVCKPT01"
+HEADER_LEN = Struct("<L")
+COMPRESS_LEVEL = 6
+
+
+def save_checkpoint(filepath: str, sys_bus: SystemInterface, harts: List[RV64Hart]):
+    
+    blobs : List[bytes] = []
+    blob_index : Dict[bytes, int] = {}
+    
+    devices = []
+    for (start, end), dev in zip(sys_bus.mem_map, sys_bus.dev_list):
+        pages = []
+        for n, page in dev.dump_pages():
+            key = blake2b(page, digest_size=16).digest()
+            idx = blob_index.get(key)
+            if idx is None:
+                idx = blob_index[key] = len(blobs)
+                blobs.append(zlib.compress(page, COMPRESS_LEVEL))
+            pages.append((n, idx))
+        devices.append({
+            "name" : dev.name,
+            "type" : type(dev).__name__,
+            "start" : start,
+            "size" : dev.size,
+            "state" : dev.get_state(),
+            "pages" : pages,
+        })
+    
+    offsets = []
+    offset = 0
+    for blob in blobs:
+        offsets.append((offset, len(blob)))
+        offset += len(blob)
+    
+    header = {
+        "harts" : [hart.snapshot()._asdict() for hart in harts],
+        "devices" : devices,
+        "blobs" : offsets,
+    }
+    for state in header["harts"]:
+        state["mode"] = state["mode"].value
+    header = zlib.compress(json.dumps(header).encode(), COMPRESS_LEVEL)
+    
+    with open(filepath, "wb") as f:
+        f.write(MAGIC)
+        f.write(HEADER_LEN.pack(len(header)))
+        f.write(header)
+        for blob in blobs:
+            f.write(blob)
+    
+    n_pages = sum(len(d["pages"]) for d in devices)
+    log.info(f"checkpoint {filepath}: {n_pages} pages, {len(blobs)} unique, "\
+        f"{offset+len(header)} bytes")
+
+
+def load_checkpoint(filepath: str, sys_bus: SystemInterface, harts: List[RV64Hart]):
+    
+    with open(filepath, "rb") as f:
+        data = memoryview(f.read())
+    
+    if data[:len(MAGIC)] != MAGIC:
+        raise Exception(f"{filepath} is not a checkpoint")
+    pos = len(MAGIC)
+    (header_len,) = HEADER_LEN.unpack_from(data, pos)
+    pos += HEADER_LEN.size
+    header = json.loads(zlib.decompress(data[pos:pos+header_len]))
+    pos += header_len
+    
+    if len(header["harts"]) != len(harts) or \
+            len(header["devices"]) != len(sys_bus.dev_list):
+        raise Exception(f"{filepath} was saved from a different machine")
+    devices = list(zip(sys_bus.mem_map, sys_bus.dev_list))
+    for ((start, end), dev), saved in zip(devices, header["devices"]):
+        if (saved["name"], saved["type"], saved["start"], saved["size"]) != \
+                (dev.name, type(dev).__name__, start, dev.size):
+            raise Exception(f"device {dev.name} at 0x{start:X} does not "\
+                f"match {saved['name']} in {filepath}")
+    
+    # each unique page is decompressed once, dict lookups share the bytes
+    blobs = [zlib.decompress(data[pos+off:pos+off+n]) 
+        for off, n in header["blobs"]]
+    
+    for (_, dev), saved in zip(devices, header["devices"]):
+        dev.restore_pages({n: blobs[idx] for n, idx in saved["pages"]})
+        dev.set_state(saved["state"])
+    
+    for hart, state in zip(harts, header["harts"]):
+        state["mode"] = Mode(state["mode"])
+        hart.restore(HartState(**state))
@@ -0,0 +1,157 @@
+"""
+Core Local Interruptor: the msip, mtimecmp and mtime registers of the
+SiFive CLINT layout, and the event scheduler that drives simulated time.
+
+    clint = ClintDevice()
+    sys_bus.register_device(clint, CLINT_BASE)
+    clint.attach(hart)
+
+Simulated time is counted in mtime ticks, one per retired instruction. The
+harts do not look at it on every instruction: their run loops advance it
+once per quantum (RV64Hart.tick()), which fires the events that are due,
+e.g. a timer setting mip.MTIP. A hart executing WFI with nothing pending
+jumps straight to the next event instead of spinning until it.
+"""
+import heapq
+import logging
+from typing import Callable, Dict, Hashable, List, Tuple
+
+from devices import BaseDevice
+
+log = logging.getLogger(__name__)
+
+CLINT_BASE = 0x0200_0000
+CLINT_SIZE = 0x1_0000
+# register offsets, msip and mtimecmp are indexed by hartid
+MSIP = 0x0
+MTIMECMP = 0x4000
+MTIME = 0xbff8
+
+MIP_MSIP = 1<<3
+MIP_MTIP = 1<<7
+
+
+class EventScheduler:
+    """
+    Callbacks keyed on the simulated time, in a heap. Scheduling an event
+    under the key of a pending one replaces it: the old entry stays in the
+    heap and is dropped when it comes out
+    """
+
+    def __init__(self):
+        self.now : int = 0
+        self.heap : List[Tuple[int, int, Hashable, Callable]] = []
+        # key -> sequence number of its live event
+        self.live : Dict[Hashable, int] = {}
+        self.seq : int = 0
+
+    def schedule(self, time: int, key: Hashable, callback: Callable[[], None]):
+        self.seq += 1
+        self.live[key] = self.seq
+        heapq.heappush(self.heap, (time, self.seq, key, callback))
+
+    def cancel(self, key: Hashable):
+        self.live.pop(key, None)
+
+    def next_time(self) -> int:
+        """time of the next live event, None if there is none"""
+        heap = self.heap
+        while heap and self.live.get(heap[0][2]) != heap[0][1]:
+            heapq.heappop(heap)
+        return heap[0][0] if heap else None
+
+    def advance(self, ticks: int):
+        self.now += ticks
+        if self.heap and self.heap[0][0] <= self.now:
+            self.run_due()
+
+    def run_due(self):
+        heap = self.heap
+        live = self.live
+        while heap and heap[0][0] <= self.now:
+            time, seq, key, callback = heapq.heappop(heap)
+            if live.get(key) == seq:
+                del live[key]
+                callback()
+
+    def skip(self) -> int:
+        """jump to the next event and run it, returns the ticks skipped"""
+        time = self.next_time()
+        if time is None or time <= self.now:
+            return 0
+        skipped = time-self.now
+        self.now = time
+        self.run_due()
+        return skipped
+
+
+class ClintDevice(BaseDevice):
+
+    def __init__(self, name="CLINT"):
+        super().__init__(CLINT_SIZE, name)
+        self.events = EventScheduler()
+        # attached harts by hartid, their mip is driven from here
+        self.harts : Dict[int, object] = {}
+
+    def attach(self, hart):
+        self.harts[hart.hartid] = hart
+        hart.clint = self
+        # mtimecmp is 0 at reset, a pending timer until it is written
+        self.update_timer(hart.hartid)
+
+    def read(self, addr: int, size: int = 4) -> int:
+        if addr >= MTIME:
+            super().write(MTIME, self.events.now, 8)
+        return super().read(addr, size)
+
+    def write(self, addr: int, value: int, size: int = 4):
+        super().write(addr, value, size)
+        # a 32 bit hart writes the 64 bit registers one half at a time, each
+        # write takes effect on its own
+        if addr >= MTIME:
+            self.events.now = super().read(MTIME, 8)
+            for hartid in self.harts:
+                self.update_timer(hartid)
+        elif addr >= MTIMECMP:
+            self.update_timer((addr-MTIMECMP)>>3)
+        else:
+            self.update_msip(addr>>2)
+
+    def update_msip(self, hartid: int):
+        hart = self.harts.get(hartid)
+        if hart is not None:
+            self._set_mip(hart, MIP_MSIP, super().read(MSIP+4*hartid, 4) & 1)
+
+    def update_timer(self, hartid: int):
+        """MTIP follows mtime >= mtimecmp, an event fires when it is due"""
+        hart = self.harts.get(hartid)
+        if hart is None:
+            return
+        events = self.events
+        cmp = super().read(MTIMECMP+8*hartid, 8)
+        if events.now >= cmp:
+            events.cancel(("mtimecmp", hartid))
+            self._set_mip(hart, MIP_MTIP, 1)
+        else:
+            self._set_mip(hart, MIP_MTIP, 0)
+            events.schedule(cmp, ("mtimecmp", hartid),
+                lambda: self.update_timer(hartid))
+
+    @staticmethod
+    def _set_mip(hart, bit: int, on: int):
+        regs = hart.csr.regs
+        mip = hart.csr.name_to_addr["mip"]
+        regs[mip] = regs[mip] | bit if on else regs[mip] & ~bit
+
+    # ---- CHECKPOINT ---- #
+
+    def get_state(self) -> Dict:
+        return {"mtime": self.events.now}
+
+    def set_state(self, state: Dict):
+        # msip and mtimecmp are in the memory, the events are rebuilt
+        self.events = EventScheduler()
+        self.events.now = state.get("mtime", 0)
+        for hartid in self.harts:
+            self.update_msip(hartid)
+            self.update_timer(hartid)
@@ -36,6 +36,10 @@ class SYS_F12(Enum):
     EBREAK = 0x000
     MRET = 0x302
     SRET = 0x102
+    WFI = 0x105
+
+# f7 of SFENCE.VMA, rs2/rs1 select the ASID/address (ignored, all is flushed)
+SFENCE_VMA_F7 = 0b0001001
     
 class OP_F3(Enum):
     ADD_SUB = 0b000
@@ -46,6 +50,88 @@ class OP_F3(Enum):
     SRX =  0b101
     OR = 0b110 
     AND = 0b111
+
+# OP/OP_32 with this f7 are the M extension multiply/divide
+MULDIV_F7 = 0b0000001
+
+# Zba/Zbb/Zbc/Zbs f7 of OP/OP_32, or imm[11:5] of OP_IMM/OP_IMM_32 (RV64
+# shifts by an immediate keep shamt[5] in the lowest bit)
+class ZB_F7(Enum):
+    SHADD = 0b0010000         # sh1add, sh2add, sh3add (.uw on OP_32)
+    ADD_UW = 0b0000100        # add.uw, zext.h (OP_32), slli.uw (OP_IMM_32)
+    INV = 0b0100000           # andn, orn, xnor (the SUB f7)
+    MINMAX_CLMUL = 0b0000101  # min, minu, max, maxu, clmul, clmulr, clmulh
+    ROT = 0b0110000           # rol, ror, rori, the unary Zbb ops (OP_IMM)
+    BCLR_BEXT = 0b0100100
+    BINV = 0b0110100
+    BSET_ORC = 0b0010100      # bset, orc.b (OP_IMM f3=5)
+    REV8 = 0b0110101          # rev8 (OP_IMM f3=5)
+
+# Zbb operations selected by rs2, on OP_IMM/OP_IMM_32 with f7 ZB_F7.ROT
+# (zext.h: OP_32 ADD_UW, orc.b and rev8: their own f7)
+class ZBB_RS2(Enum):
+    CLZ = 0b00000
+    CTZ = 0b00001
+    CPOP = 0b00010
+    SEXT_B = 0b00100
+    SEXT_H = 0b00101
+    ORC_B = 0b00111
+    REV8 = 0b11000
+
+class MULDIV_F3(Enum):
+    MUL = 0b000
+    MULH = 0b001
+    MULHSU = 0b010
+    MULHU = 0b011
+    DIV = 0b100
+    DIVU = 0b101
+    REM = 0b110
+    REMU = 0b111
+
+# f7 of the AMO opcode is f5<<2 | aq<<1 | rl
+class AMO_F5(Enum):
+    AMOADD = 0b00000
+    AMOSWAP = 0b00001
+    LR = 0b00010
+    SC = 0b00011
+    AMOXOR = 0b00100
+    AMOOR = 0b01000
+    AMOAND = 0b01100
+    AMOMIN = 0b10000
+    AMOMAX = 0b10100
+    AMOMINU = 0b11000
+    AMOMAXU = 0b11100
+
+class AMO_F3(Enum):
+    W = 0b010
+    D = 0b011
+
+# OP_FP f7 is f5<<2 | fmt, f3 is the rounding mode or selects the operation
+class FP_F5(Enum):
+    FADD = 0b00000
+    FSUB = 0b00001
+    FMUL = 0b00010
+    FDIV = 0b00011
+    FSGNJ = 0b00100
+    FMINMAX = 0b00101
+    FCVT_FMT = 0b01000 # fcvt.s.d, fcvt.d.s
+    FSQRT = 0b01011
+    FCMP = 0b10100
+    FCVT_TO_INT = 0b11000
+    FCVT_FROM_INT = 0b11010
+    FMV_X_FCLASS = 0b11100
+    FMV_FROM_X = 0b11110
+
+class FP_FMT(Enum):
+    S = 0b00
+    D = 0b01
+
+class FP_LS_F3(Enum):
+    W = 0b010
+    D = 0b011
+
+# rounding mode field value selecting frm
+FRM_DYN = 0b111
     
 class LD_F3(Enum):
     LB = 0b000
@@ -139,6 +225,14 @@ class ExceptionCode(Enum):
     SoftwareSheck = 18
     HardwareError = 19
 
+class InterruptCode(Enum):
+    SupervisorSoftware = 1
+    MachineSoftware = 3
+    SupervisorTimer = 5
+    MachineTimer = 7
+    SupervisorExternal = 9
+    MachineExternal = 11
+
 CSR_M = {    
     "mvendorid":(0xf11, 32, {"bank": [31, 7],"Offset": [6, 0]}),
     "marchid":  (0xf12, 64, {"Architecture_ID": [63, 0]}),
@@ -150,7 +244,7 @@ CSR_M = {
             "UBE" : [6], "MPIE": [7], "SPP": [8],"VS" : [10, 9], "MPP": [12, 11], 
             "FS": [14, 13],"XS": [16, 15], "MPRV": [17], "SUM": [18], "MXR": [19],
             "TVM": [20], "TW": [21], "TSR": [22], "SPLEP": [23], "SDT": [24], 
-            "UXL": [33, 32],"SXL": [35, 34], "SBE": [63], "MBE": [37], 
+            "UXL": [33, 32],"SXL": [35, 34], "SBE": [36], "MBE": [37], 
             "GVA": [38], "MPV": [39], "MPLEP": [41], "MDT": [42], "SD": [63]
             }),
     "misa":     (0x301, 64, {"MXLEN": [63, 62], "Extensions": [25, 0]}),
@@ -159,7 +253,7 @@ CSR_M = {
     "mie":      (0x304, 64, {"SSIE": [1], "MSIE": [3], "STIE": [5], "MTIE": [7],
                         "SEIE": [9], "MEIE": [11], "LCOFIE": [13]}),
     "mtvec":    (0x305, 64, {"BASE": [63, 2], "MODE": [1, 0]}),
-    # mcountern
+    "mcounteren": (0x306, 32, {}),
     "mscratch": (0x340, 64, {}),
     "mepc":     (0x341, 64, {}),
     "mcause":   (0x342, 64, {"INT":[63], "CODE": [62, 0]}),
@@ -189,15 +283,119 @@ CSR_M = {
     "tdata3": (0x7a3, 64, {}),
 }
 
+# WARL write masks for software writes (CSR instructions), bits outside the
+# mask keep their value. CSRs not listed are fully writable, read-only CSRs
+# (addr[11:10]==0b11) are rejected before the write
+CSR_WARL = {
+    # SIE, MIE, SPIE, MPIE, SPP, MPP, MPRV, SUM, MXR, TVM, TW, TSR
+    "mstatus":  (1<<1)|(1<<3)|(1<<5)|(1<<7)|(1<<8)|(0b11<<11)|(1<<17)|(1<<18)\
+                |(1<<19)|(1<<20)|(1<<21)|(1<<22),
+    "misa":     0, # extensions can't be turned off
+    # no delegation of ecall from M
+    "medeleg":  0xb3ff,
+    "mideleg":  0x222,
+    "mie":      0xaaa,
+    # MODE is direct or vectored only
+    "mtvec":    ~0b10,
+    # IALIGN=32, no compressed instructions
+    "mepc":     ~0b11,
+    # only the S-mode pending bits are writable from M-mode
+    "mip":      0x222,
+    # SIE, SPIE, SPP, SUM, MXR
+    "sstatus":  (1<<1)|(1<<5)|(1<<8)|(1<<18)|(1<<19),
+    "sie":      0x222,
+    # only SSIP, STIP/SEIP come from the platform
+    "sip":      0x2,
+    "stvec":    ~0b10,
+    "sepc":     ~0b11,
+    # no ASID bits (ASIDLEN=0)
+    "satp":     (0xf<<60)|((1<<44)-1),
+    "fcsr":     0xff,
+}
+
 CSR_S = {
-    "satp":     (0x180, 64, {}), 
-    "stvec":    (0x105, 64, {}), 
-    "scountern":(0x106, 64, {}), 
+    # sstatus, sie and sip are restricted views of the M-mode registers, see
+    # CSR_ALIAS
+    "sstatus":  (0x100, 64, {
+            "SIE": [1], "SPIE": [5], "UBE" : [6], "SPP": [8], "VS" : [10, 9], 
+            "FS": [14, 13],"XS": [16, 15], "SUM": [18], "MXR": [19], 
+            "UXL": [33, 32], "SD": [63]
+            }),
+    "sie":      (0x104, 64, {"SSIE": [1], "STIE": [5], "SEIE": [9]}),
+    "stvec":    (0x105, 64, {"BASE": [63, 2], "MODE": [1, 0]}), 
+    "scounteren":(0x106, 32, {}), 
+    "sscratch": (0x140, 64, {}),
+    "sepc":     (0x141, 64, {}),
+    "scause":   (0x142, 64, {"INT":[63], "CODE": [62, 0]}),
+    "stval":    (0x143, 64, {}),
+    "sip":      (0x144, 64, {"SSIP": [1], "STIP": [5], "SEIP": [9]}),
+    "satp":     (0x180, 64, {"MODE": [63, 60], "ASID": [59, 44], 
+                        "PPN": [43, 0]}), 
+}
+
+# CSRs that are a masked view of another one: (target, read mask, shift),
+# the view reads (target & read mask)>>shift and software writes change
+# target & read mask & WARL mask of the view
+SSTATUS_MASK = (1<<1)|(1<<5)|(1<<6)|(1<<8)|(0b11<<9)|(0b11<<13)|(0b11<<15)\
+    |(1<<18)|(1<<19)|(0b11<<32)|(1<<63)
+CSR_ALIAS = {
+    "sstatus":  ("mstatus", SSTATUS_MASK, 0),
+    "sie":      ("mie", 0x222, 0),
+    "sip":      ("mip", 0x222, 0),
+    "cycle":    ("mcycle", -1, 0),
+    "instret":  ("minstret", -1, 0),
+    "fflags":   ("fcsr", 0x1f, 0),
+    "frm":      ("fcsr", 0xe0, 5),
 }
 
+# satp.MODE values, a write with any other MODE is ignored
+SATP_BARE, SATP_SV39, SATP_SV48 = 0, 8, 9
+# RV32 satp.MODE (a single bit)
+SATP32_SV32 = 1
+
+# RV32: every CSR is at most 32 bit wide, the fields above bit 31 are dropped
+# (mstatush and the like are not implemented), the wider ones clamped to
+# bit 31 and these ones moved
+CSR_RV32_FIELDS = {
+    "mstatus":  {"SD": [31]},
+    "sstatus":  {"SD": [31]},
+    "misa":     {"MXLEN": [31, 30]},
+    "mcause":   {"INT": [31], "CODE": [30, 0]},
+    "scause":   {"INT": [31], "CODE": [30, 0]},
+    "satp":     {"MODE": [31], "ASID": [30, 22], "PPN": [21, 0]},
+}
+CSR_RV32_ALIAS = {
+    "sstatus":  ("mstatus", (SSTATUS_MASK & 0xffff_ffff) | (1<<31), 0),
+}
+# RV32: the 64 bit counters are read and written 32 bit at a time, the
+# upper halves through these CSRs
+CSR_RV32_HIGH = {
+    "mcycle":   ("mcycleh", 0xb80),
+    "minstret": ("minstreth", 0xb82),
+    "cycle":    ("cycleh", 0xc80),
+    "time":     ("timeh", 0xc81),
+    "instret":  ("instreth", 0xc82),
+}
+CSR_RV32_WARL = {
+    # Sv32, no ASID bits
+    "satp":     (1<<31)|((1<<22)-1),
+}
+
+# the counters advance once per run loop quantum and catch up when a CSR
+# instruction accesses them, time is the CLINT mtime (see sync_counters())
 CSR_U = {
     "cycle":    (0xc00, 64, {}), 
-    
+    "time":     (0xc01, 64, {}), 
+    "instret":  (0xc02, 64, {}), 
+}
+
+# F/D, fflags and frm are views of fcsr (CSR_ALIAS)
+CSR_F = {
+    "fcsr":     (0x003, 32, {"FRM": [7, 5], "NV": [4], "DZ": [3], "OF": [2], 
+                        "UF": [1], "NX": [0]}),
+    "fflags":   (0x001, 32, {"NV": [4], "DZ": [3], "OF": [2], "UF": [1], 
+                        "NX": [0]}),
+    "frm":      (0x002, 32, {}),
 }
  
 # CSR_U = {
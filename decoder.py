@@ -0,0 +1,75 @@
+from cpu_enums import *
+from utils import sign_extend
+
+MASK64 = 0xffff_ffff_ffff_ffff
+MASK32 = 0xffff_ffff
+SIGN64 = 1<<63
+SIGN32 = 1<<31
+
+# immediate format used by each major opcode, the decoder only builds the
+# immediate the instruction actually needs
+FMT_R, FMT_I, FMT_S, FMT_B, FMT_U, FMT_J = range(6)
+
+OPS_FMT = {
+    Ops.LOAD.value      : FMT_I,
+    Ops.LOAD_FP.value   : FMT_I,
+    Ops.MISC_MEM.value  : FMT_I,
+    Ops.OP_IMM.value    : FMT_I,
+    Ops.OP_IMM_32.value : FMT_I,
+    Ops.JALR.value      : FMT_I,
+    Ops.SYSTEM.value    : FMT_I,
+    Ops.STORE.value     : FMT_S,
+    Ops.STORE_FP.value  : FMT_S,
+    Ops.BRANCH.value    : FMT_B,
+    Ops.AUIPC.value     : FMT_U,
+    Ops.LUI.value       : FMT_U,
+    Ops.JAL.value       : FMT_J,
+}
+
+
+class Decoded:
+    """Predecoded instruction, built once per PC and kept in the hart cache"""
+
+    __slots__ = ("handler", "op", "rd", "rs1", "rs2", "f3", "f7", "imm", "raw",
+        "ilen")
+
+    def __init__(self, raw: int, ilen: int = 4):
+        # raw is the 32 bit expansion of a compressed (ilen 2) instruction
+        self.raw = raw
+        self.ilen = ilen
+        self.op = raw & 0x7f
+        self.rd = (raw>>7) & 0x1f
+        self.f3 = (raw>>12) & 0x7
+        self.rs1 = (raw>>15) & 0x1f
+        self.rs2 = (raw>>20) & 0x1f
+        self.f7 = raw>>25
+        self.imm = decode_imm(raw, OPS_FMT.get(self.op, FMT_R))
+        self.handler = None
+
+    def __repr__(self):
+        try:
+            name = Ops(self.op).name
+        except ValueError:
+            name = f"0b{self.op:07b}"
+        if self.ilen == 2:
+            name = "C." + name
+        return f"{name}(rd={self.rd}, rs1={self.rs1}, rs2={self.rs2}, "\
+            f"f3={self.f3}, f7={self.f7}, imm=0x{self.imm:x})"
+
+
+def decode_imm(raw: int, fmt: int) -> int:
+    if fmt == FMT_I:
+        imm = sign_extend(raw>>20, 12)
+    elif fmt == FMT_S:
+        imm = sign_extend((raw>>25)<<5 | (raw>>7)&0x1f, 12)
+    elif fmt == FMT_B:
+        imm = sign_extend((raw>>31)<<12 | ((raw>>7)&0x1)<<11 | \
+            ((raw>>25)&0x3f)<<5 | ((raw>>8)&0xf)<<1, 13)
+    elif fmt == FMT_U:
+        imm = sign_extend(raw & 0xffff_f000, 32)
+    elif fmt == FMT_J:
+        imm = sign_extend((raw>>31)<<20 | ((raw>>12)&0xff)<<12 | \
+            ((raw>>20)&0x1)<<11 | ((raw>>21)&0x3ff)<<1, 21)
+    else:
+        return 0
+    return imm & MASK64
@@ -1,34 +1,51 @@
 import logging
-from struct import pack, unpack
+import os
+import mmap
+from struct import Struct, error as StructError
+from typing import Dict, Iterator, Tuple
 
 
 log = logging.getLogger(__name__)
 
+# precompiled little endian accessors by access size in bytes
+_ENC = {1: "<B", 2: "<H", 4: "<L", 8: "<Q"}
+UNPACK_FROM = {size: Struct(enc).unpack_from for size, enc in _ENC.items()}
+PACK_INTO = {size: Struct(enc).pack_into for size, enc in _ENC.items()}
+SIZE_MASK = {size: (1<<(size*8))-1 for size in _ENC}
+
+PAGE_SHIFT = 12
+PAGE_SIZE = 1<<PAGE_SHIFT
+PAGE_MASK = PAGE_SIZE-1
+ZERO_PAGE = bytes(PAGE_SIZE)
+
 class BaseDevice:
     
     def __init__(self, size, name="dev"):
         self.size : int = size
         self.name : str = name
-        self.mem : bytearray = b'\x00'*self.size
+        self.mem : bytearray = bytearray(self.size)
     
     def read(self, addr: int, size: int = 4) -> int:
-        assert addr>=0, "something is wrong addr < 0" 
-        assert addr+size<=self.size-1, \
-            f"addr: {hex(addr+size)} is more than dev size"
+        assert 0<=addr and addr+size<=self.size, \
+            f"addr: {hex(addr+size)} is out of dev range"
         
-        enc_str = self.get_encoding(size)
-        return unpack(enc_str, self.mem[addr:addr+size])[0]
+        return UNPACK_FROM[size](self.mem, addr)[0]
     
     def write(self, addr: int, value: int, size: int = 4):
+        assert 0<=addr and addr+size<=self.size, \
+            f"addr: {hex(addr+size)} is out of dev range"
         
-        assert addr>=0, "something is wrong addr < 0" 
-        assert addr+size<=self.size-1, \
-            f"addr: {hex(addr+size)} is more than dev size"
-        
-        mask = (1<<(size*8))-1
-        enc_str = self.get_encoding(size)
-        data = pack(enc_str, value&mask)
-        self.mem = self.mem[:addr] + data + self.mem[addr+size:]
+        PACK_INTO[size](self.mem, addr, value&SIZE_MASK[size])
+    
+    def amo(self, addr: int, op, value: int, size: int = 4) -> int:
+        """
+        atomic read-modify-write, op(old, value) is stored and the old value
+        returned. Generic version on top of read/write, the memories do it
+        in place
+        """
+        old = self.read(addr, size)
+        self.write(addr, op(old, value), size)
+        return old
     
     @staticmethod
     def round4Kb(n: int) -> int:
@@ -45,13 +62,46 @@ class BaseDevice:
         else:
             return "<B"
     
-    def hexdump(self, width: int = 16):
+    def load(self, data: bytes, offset: int = 0):
+        """copy data into the device starting at offset"""
+        assert 0<=offset and offset+len(data)<=self.size, \
+            f"data does not fit in {self.name}"
+        
+        self.mem[offset:offset+len(data)] = data
+    
+    # ---- CHECKPOINT ---- #
+    
+    def get_state(self) -> Dict:
+        """device state other than its memory, must be json serializable"""
+        return {}
+    
+    def set_state(self, state: Dict):
+        pass
+    
+    def dump_pages(self) -> Iterator[Tuple[int, bytes]]:
+        """(page number, 4KiB content) of every page that is not all zero"""
+        mem = self.mem
+        for off in range(0, len(mem), PAGE_SIZE):
+            page = bytes(mem[off:off+PAGE_SIZE])
+            if page.count(0) != len(page):
+                yield off>>PAGE_SHIFT, page.ljust(PAGE_SIZE, b"\0")
+    
+    def restore_pages(self, pages: Dict[int, bytes]):
+        """inverse of dump_pages(), pages not given are zero"""
+        mem = self.mem
+        mem[:] = bytes(len(mem))
+        for n, data in pages.items():
+            off = n<<PAGE_SHIFT
+            mem[off:off+PAGE_SIZE] = data[:len(mem)-off]
+    
+    def hexdump(self, width: int = 16, data: bytearray = None, base: int = 0):
         def is_printable(b):
             return 32 <= b <= 126
 
         previous_chunk = None
         skipping = False
-        data = self.mem
+        if data is None:
+            data = self.mem
         for offset in range(0, len(data), width):
             chunk = data[offset:offset + width]
 
@@ -75,13 +125,13 @@ class BaseDevice:
             if len(chunk) > 8:
                 hex_part = f"{hex_part[:3*8]} {hex_part[3*8:]}"
 
-            print(f"{offset:08X}  {hex_part}  |{ascii_repr}|")
+            print(f"{base+offset:08X}  {hex_part}  |{ascii_repr}|")
 
-        print(f"{len(data):08X}")
+        print(f"{base+len(data):08X}")
     
-    def size_str(self):
+    def size_str(self, size: int = None):
         
-        s = self.size/8
+        s = (self.size if size is None else size)/8
         
         if s>1e9:
             return f"{s/1e9:.1f}Gb"
@@ -101,22 +151,249 @@ class MemoryDevice(BaseDevice):
     def __init__(self, size, name="mem"):
         super().__init__(size, name)
     
+    def amo(self, addr: int, op, value: int, size: int = 4) -> int:
+        assert 0<=addr and addr+size<=self.size, \
+            f"addr: {hex(addr+size)} is out of dev range"
+        
+        old = UNPACK_FROM[size](self.mem, addr)[0]
+        PACK_INTO[size](self.mem, addr, op(old, value)&SIZE_MASK[size])
+        return old
+    
     @classmethod
     def from_binary_file(
             cls: 'BaseDevice', 
             filepath: str, 
             name='dev') -> 'MemoryDevice':
         
+        size = os.path.getsize(filepath)
+        newdev = cls(size=cls.round4Kb(size), name=name)
+        # read straight into the device memory, the padding is already zero
+        with open(filepath, 'rb') as f:
+            f.readinto(memoryview(newdev.mem)[:size])
+
+        return newdev
+
+
+class SparseMemoryDevice(BaseDevice):
+    """
+    RAM allocated in 4KiB pages on first write, untouched pages read as 
+    zero. Same read/write interface as MemoryDevice, so a guest can be
+    given GiBs of RAM while the host only holds the pages it touched.
+    """
+    
+    def __init__(self, size, name="mem"):
+        self.size : int = size
+        self.name : str = name
+        self.pages : Dict[int, bytearray] = {}
+    
+    @property
+    def resident_size(self) -> int:
+        return len(self.pages)*PAGE_SIZE
+    
+    def read(self, addr: int, size: int = 4) -> int:
+        assert 0<=addr and addr+size<=self.size, \
+            f"addr: {hex(addr+size)} is out of dev range"
+        
+        offset = addr&PAGE_MASK
+        if offset+size>PAGE_SIZE:
+            return self._read_split(addr, size)
+        page = self.pages.get(addr>>PAGE_SHIFT)
+        if page is None:
+            return 0
+        return UNPACK_FROM[size](page, offset)[0]
+    
+    def write(self, addr: int, value: int, size: int = 4):
+        assert 0<=addr and addr+size<=self.size, \
+            f"addr: {hex(addr+size)} is out of dev range"
+        
+        offset = addr&PAGE_MASK
+        if offset+size>PAGE_SIZE:
+            return self._write_split(addr, value, size)
+        value &= SIZE_MASK[size]
+        page = self.pages.get(addr>>PAGE_SHIFT)
+        if page is None:
+            if not value: # writing zero to a zero page, stay sparse
+                return
+            page = self.pages[addr>>PAGE_SHIFT] = bytearray(PAGE_SIZE)
+        PACK_INTO[size](page, offset, value)
+    
+    def amo(self, addr: int, op, value: int, size: int = 4) -> int:
+        assert 0<=addr and addr+size<=self.size, \
+            f"addr: {hex(addr+size)} is out of dev range"
+        
+        # AMOs are naturally aligned, never split
+        page = self.pages.get(addr>>PAGE_SHIFT)
+        if page is None:
+            page = self.pages[addr>>PAGE_SHIFT] = bytearray(PAGE_SIZE)
+        offset = addr&PAGE_MASK
+        old = UNPACK_FROM[size](page, offset)[0]
+        PACK_INTO[size](page, offset, op(old, value)&SIZE_MASK[size])
+        return old
+    
+    # misaligned accesses crossing a page boundary go byte by byte
+    def _read_split(self, addr: int, size: int) -> int:
+        value = 0
+        for i in range(size):
+            value |= self.read(addr+i, 1)<<(8*i)
+        return value
+    
+    def _write_split(self, addr: int, value: int, size: int):
+        for i in range(size):
+            self.write(addr+i, (value>>(8*i))&0xff, 1)
+    
+    def load(self, data: bytes, offset: int = 0):
+        """copy data into the device starting at offset"""
+        assert 0<=offset and offset+len(data)<=self.size, \
+            f"data does not fit in {self.name}"
+        
+        view = memoryview(data)
+        pos = 0
+        while pos<len(data):
+            addr = offset+pos
+            page_off = addr&PAGE_MASK
+            n = min(PAGE_SIZE-page_off, len(data)-pos)
+            page = self.pages.get(addr>>PAGE_SHIFT)
+            if page is None:
+                page = self.pages[addr>>PAGE_SHIFT] = bytearray(PAGE_SIZE)
+            page[page_off:page_off+n] = view[pos:pos+n]
+            pos += n
+    
+    @classmethod
+    def from_binary_file(
+            cls: 'BaseDevice', 
+            filepath: str, 
+            size: int = None,
+            name='dev') -> 'SparseMemoryDevice':
+        """
+        load the image at the start of a device of `size` bytes, by default
+        the file size rounded to 4KiB
+        """
         with open(filepath, 'rb') as f:
             data = f.read()
         
-        size = len(data)
-        round_size = cls.round4Kb(len(data))
-        newdev = cls(size=round_size, name=name)
-        data = data+b'\x00'*(round_size-size)
-        newdev.mem = data
-
+        if size is None:
+            size = cls.round4Kb(len(data))
+        newdev = cls(size=size, name=name)
+        newdev.load(data)
+        
         return newdev
     
+    def dump_pages(self) -> Iterator[Tuple[int, bytes]]:
+        for n in sorted(self.pages):
+            page = self.pages[n]
+            if page != ZERO_PAGE:
+                yield n, bytes(page)
+    
+    def restore_pages(self, pages: Dict[int, bytes]):
+        self.pages = {n: bytearray(data) for n, data in pages.items()}
+    
+    def hexdump(self, width: int = 16):
+        for n in sorted(self.pages):
+            super().hexdump(width, self.pages[n], n<<PAGE_SHIFT)
+    
+    def __repr__(self):
+        return f"{self.__class__.__name__}(name={self.name}, "\
+            f"size={self.size_str()}, resident={self.size_str(self.resident_size)})"
+
+
+class MappedMemoryDevice(BaseDevice):
+    """
+    RAM backed by a private (copy-on-write) mmap of an image file. Pages are 
+    loaded lazily by the OS and shared through the page cache until the
+    guest writes them, writes never reach the file. Bytes past the end of 
+    the file, up to the device size, live in a SparseMemoryDevice.
+    """
+    
+    def __init__(self, filepath: str, size: int = None, name="mem"):
+        self.filepath : str = str(filepath)
+        with open(filepath, 'rb') as f:
+            self.mem = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        self.mapped : int = len(self.mem)
+        self.size : int = self.round4Kb(self.mapped) if size is None else size
+        self.name : str = name
+        assert self.size>=self.mapped, f"{filepath} does not fit in {name}"
+        self.tail = SparseMemoryDevice(self.size-self.mapped, f"{name}.tail")
+    
+    def read(self, addr: int, size: int = 4) -> int:
+        try:
+            return UNPACK_FROM[size](self.mem, addr)[0]
+        except StructError: # past the mapped file
+            return self._read_slow(addr, size)
+    
+    def write(self, addr: int, value: int, size: int = 4):
+        try:
+            PACK_INTO[size](self.mem, addr, value&SIZE_MASK[size])
+        except StructError:
+            self._write_slow(addr, value, size)
+    
+    def amo(self, addr: int, op, value: int, size: int = 4) -> int:
+        try:
+            old = UNPACK_FROM[size](self.mem, addr)[0]
+        except StructError: # past the mapped file
+            return super().amo(addr, op, value, size)
+        PACK_INTO[size](self.mem, addr, op(old, value)&SIZE_MASK[size])
+        return old
+    
+    def _read_slow(self, addr: int, size: int) -> int:
+        assert 0<=addr and addr+size<=self.size, \
+            f"addr: {hex(addr+size)} is out of dev range"
+        if addr>=self.mapped:
+            return self.tail.read(addr-self.mapped, size)
+        # access crossing the end of the file
+        value = 0
+        for i in range(size):
+            value |= self.read(addr+i, 1)<<(8*i)
+        return value
+    
+    def _write_slow(self, addr: int, value: int, size: int):
+        assert 0<=addr and addr+size<=self.size, \
+            f"addr: {hex(addr+size)} is out of dev range"
+        if addr>=self.mapped:
+            return self.tail.write(addr-self.mapped, value, size)
+        for i in range(size):
+            self.write(addr+i, (value>>(8*i))&0xff, 1)
+    
+    def load(self, data: bytes, offset: int = 0):
+        assert 0<=offset and offset+len(data)<=self.size, \
+            f"data does not fit in {self.name}"
+        
+        n = max(0, min(len(data), self.mapped-offset))
+        self.mem[offset:offset+n] = data[:n]
+        if n<len(data):
+            self.tail.load(data[n:], offset+n-self.mapped)
+    
+    # pages of the mapping are numbered from 0, the tail pages follow them
+    @property
+    def mapped_pages(self) -> int:
+        return (self.mapped+PAGE_MASK)>>PAGE_SHIFT
+    
+    def dump_pages(self) -> Iterator[Tuple[int, bytes]]:
+        yield from super().dump_pages()
+        first = self.mapped_pages
+        for n, page in self.tail.dump_pages():
+            yield first+n, page
+    
+    def restore_pages(self, pages: Dict[int, bytes]):
+        # only the pages that differ are written, so the untouched ones stay
+        # shared with the page cache
+        mem = self.mem
+        for n in range(self.mapped_pages):
+            off = n<<PAGE_SHIFT
+            current = mem[off:off+PAGE_SIZE]
+            data = pages.get(n, ZERO_PAGE)[:len(current)]
+            if current != data:
+                mem[off:off+len(data)] = data
+        first = self.mapped_pages
+        self.tail.restore_pages(
+            {n-first: data for n, data in pages.items() if n>=first})
+    
+    @classmethod
+    def from_binary_file(
+            cls: 'BaseDevice', 
+            filepath: str, 
+            size: int = None,
+            name='dev') -> 'MappedMemoryDevice':
+        return cls(filepath, size, name)
     
-    
\ No newline at end of file
+    def close(self):
+        self.mem.close()
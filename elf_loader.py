@@ -0,0 +1,136 @@
+"""
+Minimal ELF loader for the riscv-tests executables in tests/*/elf: maps the
+PT_LOAD segments into the devices of a SystemInterface and reads the entry 
+point and the symbol table (tohost/fromhost).
+
+    elf = ElfFile("tests/rv64/elf/p/rv64ui-p-add")
+    elf.load(sys_bus)
+    hart = RV64Hart(0, sys_bus, entry_point=elf.entry)
+
+Only the file bytes of each segment are copied, the rest up to its memory
+size (.bss) is left to the device, which reads as zero until written. 
+"""
+import logging
+from struct import Struct
+from typing import Dict, List, NamedTuple
+
+from system_interface import SystemInterface
+
+log = logging.getLogger(__name__)
+
+ELF_MAGIC = b"\x7fELF"
+ELFCLASS32, ELFCLASS64 = 1, 2
+ELFDATA2LSB = 1
+EM_RISCV = 243
+PT_LOAD = 1
+SHT_SYMTAB = 2
+
+# ident is read first, the rest depends on the class (32/64 bit)
+IDENT = Struct("<4sBBBBB7x")
+EHDR = {
+    ELFCLASS32: Struct("<HHIIIIIHHHHHH"),
+    ELFCLASS64: Struct("<HHIQQQIHHHHHH"),
+}
+# program headers, normalized to (type, offset, vaddr, paddr, filesz, memsz)
+PHDR = {
+    ELFCLASS32: Struct("<IIIIIIII"),
+    ELFCLASS64: Struct("<IIQQQQQQ"),
+}
+SHDR = {
+    ELFCLASS32: Struct("<IIIIIIIIII"),
+    ELFCLASS64: Struct("<IIQQQQIIQQ"),
+}
+# (name, value)
+SYM = {
+    ELFCLASS32: Struct("<IIIBBH"),
+    ELFCLASS64: Struct("<IBBHQQ"),
+}
+
+
+class Segment(NamedTuple):
+    paddr : int
+    vaddr : int
+    offset : int
+    filesz : int
+    memsz : int
+
+
+class ElfFile:
+    
+    def __init__(self, filepath: str):
+        self.filepath : str = str(filepath)
+        with open(filepath, "rb") as f:
+            self.data : bytes = f.read()
+        
+        magic, ei_class, ei_data, _, _, _ = IDENT.unpack_from(self.data)
+        if magic != ELF_MAGIC:
+            raise Exception(f"{filepath} is not an ELF file")
+        if ei_class not in EHDR or ei_data != ELFDATA2LSB:
+            raise Exception(f"{filepath}: only little endian ELF32/64 supported")
+        self.xlen : int = 32 if ei_class == ELFCLASS32 else 64
+        
+        (e_type, e_machine, _, self.entry, e_phoff, e_shoff, _, _, 
+            e_phentsize, e_phnum, e_shentsize, e_shnum, _) = \
+            EHDR[ei_class].unpack_from(self.data, IDENT.size)
+        if e_machine != EM_RISCV:
+            raise Exception(f"{filepath} is not a RISC-V executable")
+        
+        self.segments : List[Segment] = []
+        for i in range(e_phnum):
+            p = PHDR[ei_class].unpack_from(self.data, e_phoff+i*e_phentsize)
+            if ei_class == ELFCLASS32:
+                p_type, offset, vaddr, paddr, filesz, memsz = p[:6]
+            else:
+                p_type, _, offset, vaddr, paddr, filesz, memsz, _ = p
+            if p_type == PT_LOAD and memsz:
+                self.segments.append(
+                    Segment(paddr, vaddr, offset, filesz, memsz))
+        
+        self.symbols : Dict[str, int] = {}
+        shdrs = [SHDR[ei_class].unpack_from(self.data, e_shoff+i*e_shentsize)
+            for i in range(e_shnum)]
+        for sh in shdrs:
+            if sh[1] == SHT_SYMTAB:
+                self._read_symtab(ei_class, sh, shdrs[sh[6]])
+    
+    def _read_symtab(self, ei_class: int, symtab: tuple, strtab: tuple):
+        # sh_offset, sh_size and sh_entsize are at the same index in both
+        sym_off, sym_size, sym_ent = symtab[4], symtab[5], symtab[9]
+        str_off = strtab[4]
+        for off in range(sym_off, sym_off+sym_size, sym_ent):
+            s = SYM[ei_class].unpack_from(self.data, off)
+            st_name, st_value = (s[0], s[1]) if ei_class == ELFCLASS32 \
+                else (s[0], s[4])
+            if not st_name:
+                continue
+            end = self.data.index(b"\0", str_off+st_name)
+            name = self.data[str_off+st_name:end].decode()
+            self.symbols[name] = st_value
+    
+    @property
+    def tohost(self) -> int:
+        return self.symbols.get("tohost")
+    
+    @property
+    def fromhost(self) -> int:
+        return self.symbols.get("fromhost")
+    
+    def load(self, sys_bus: SystemInterface):
+        """copy every PT_LOAD segment at its physical address"""
+        view = memoryview(self.data)
+        for seg in self.segments:
+            # raises if the end of the segment is not mapped
+            sys_bus.decode(seg.paddr+seg.memsz-1)
+            # a segment can span several regions, e.g. RAM around an overlay
+            addr, data = seg.paddr, view[seg.offset:seg.offset+seg.filesz]
+            while data:
+                start, end, dev, base = sys_bus.decode(addr)
+                n = min(len(data), end+1-addr)
+                dev.load(data[:n], addr-base)
+                addr, data = addr+n, data[n:]
+            log.debug(f"{self.filepath}: 0x{seg.paddr:X} {seg.filesz} bytes "\
+                f"+ {seg.memsz-seg.filesz} zero")
+    
+    def __repr__(self):
+        return f"ElfFile({self.filepath}, rv{self.xlen}, "\
+            f"entry=0x{self.entry:X}, {len(self.segments)} segments)"
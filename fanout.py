@@ -0,0 +1,143 @@
+"""
+Fork based fan-out: run the guest once up to an interesting point, then
+fork one child process per input. Every child starts from the identical
+machine state, shared copy-on-write with the parent, applies its input
+and sends its result back over a pipe, e.g.
+
+    run_until(hart, pc=0x8000_0100)
+
+    def child(hart, value):
+        hart.regfile[10] = value
+        run_until(hart, max_instret=100_000)
+        return hart.regfile[10]
+
+    results = fork_fanout(hart, range(16), child)
+
+A child may also patch the guest memory. The decoded instructions and the
+translated blocks are cached by the hart, code is patched with 
+patch_code() which drops them (plain data can be written on the bus).
+
+Results come back in input order, a child that raised gives a ChildError
+in its place instead of stopping the whole campaign. POSIX only.
+"""
+import os
+import pickle
+import sys
+import traceback
+from typing import Any, Callable, Iterable, List
+
+from htif import HtifDevice
+from main import RV64Hart, QUANTUM
+
+
+class ChildError(Exception):
+    """exception raised in a child, with its formatted traceback"""
+    
+    def __init__(self, input: Any, tb: str):
+        # args are the constructor arguments, so that it pickles
+        super().__init__(input, tb)
+        self.input = input
+        self.traceback = tb
+    
+    def __str__(self):
+        return f"child for input {self.input!r} failed:\n{self.traceback}"
+
+
+def run_until(hart: RV64Hart, pc: int = None, max_instret: int = None) -> int:
+    """
+    step until the hart reaches `pc`, has run `max_instret` instructions or
+    halts, returns the number of instructions run. Like run_steps(), the 
+    counters, the simulated time and the interrupts tick once per QUANTUM
+    """
+    n = 0
+    step = hart.step
+    running = True
+    while running and n != max_instret and hart.pc != pc:
+        end = n+QUANTUM if max_instret is None else min(n+QUANTUM, max_instret)
+        while n < end and hart.pc != pc:
+            n += 1
+            if not step():
+                running = False
+                break
+        # an interrupt taken here may move the pc, checked again above
+        hart.tick()
+    return n
+
+
+def patch_code(hart: RV64Hart, addr: int, data: bytes):
+    """
+    write data at the physical address addr and drop the decoded and 
+    translated instructions of the hart
+    """
+    for i, byte in enumerate(data):
+        hart.sys_bus.write(addr+i, byte, 1)
+    hart.flush_decode_cache()
+
+
+def _child_main(w: int, hart: RV64Hart, child: Callable, input: Any):
+    try:
+        try:
+            result = child(hart, input)
+        except Exception:
+            result = ChildError(input, traceback.format_exc())
+        try:
+            data = pickle.dumps(result)
+        except Exception:
+            data = pickle.dumps(ChildError(input, traceback.format_exc()))
+        with os.fdopen(w, "wb") as f:
+            f.write(data)
+    finally:
+        # no atexit handlers, the output of the child is flushed by hand
+        try:
+            for dev in hart.sys_bus.dev_list:
+                if isinstance(dev, HtifDevice):
+                    dev.out.flush()
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(0)
+
+
+def _collect(pid: int, r: int, input: Any) -> Any:
+    with os.fdopen(r, "rb") as f:
+        data = f.read()
+    _, status = os.waitpid(pid, 0)
+    if not data:
+        return ChildError(input, f"child {pid} died, wait status {status}")
+    return pickle.loads(data)
+
+
+def fork_fanout(hart: RV64Hart, inputs: Iterable[Any], 
+        child: Callable[[RV64Hart, Any], Any], jobs: int = None) -> List[Any]:
+    """
+    fork a child per input running `child(hart, input)` on its own copy of
+    the machine, at most `jobs` (default: cpu count) at the same time. The 
+    return values must be picklable.
+    """
+    if not hasattr(os, "fork"):
+        raise Exception("fork_fanout needs os.fork()")
+    if jobs is None:
+        jobs = os.cpu_count()
+    
+    # anything still buffered would be written again by every child
+    sys.stdout.flush()
+    sys.stderr.flush()
+    
+    inputs = list(inputs)
+    results : List[Any] = [None]*len(inputs)
+    running = [] # (index, pid, read fd)
+    for i, input in enumerate(inputs):
+        if len(running) >= jobs:
+            j, pid, r = running.pop(0)
+            results[j] = _collect(pid, r, inputs[j])
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+            _child_main(w, hart, child, input)
+        os.close(w)
+        running.append((i, pid, r))
+    
+    for j, pid, r in running:
+        results[j] = _collect(pid, r, inputs[j])
+    return results
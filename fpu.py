@@ -0,0 +1,435 @@
+"""
+IEEE 754 binary32/binary64 arithmetic for the F and D extensions.
+
+Operands and results are raw bit patterns (binary32 already unboxed), each
+operation returns (result, fflags). Two paths:
+
+  * fast: the host double. Taken with round to nearest even once NX is
+    already set in fflags (it is sticky, so in practice after the first
+    inexact operation) and only if the result is a normal number: no other
+    flag can then be raised. binary32 +, -, *, /, sqrt computed in double
+    and rounded once more to single give the correctly rounded result.
+  * exact: integer significands and exponents, rounded by _round() in any
+    rounding mode with all the flags. NaNs, infinities, zeros, subnormals,
+    FMA (no host fma before Python 3.13) and the first inexact result go
+    this way.
+"""
+import math
+from struct import Struct
+from typing import Tuple
+
+# fflags bits
+NX, UF, OF, DZ, NV = 1, 2, 4, 8, 16
+# rounding modes, 5 and 6 are reserved and 7 (dynamic) selects frm
+RNE, RTZ, RDN, RUP, RMM = range(5)
+
+FIN, INF, NAN = range(3)
+
+_u32 = Struct("<I")
+_f32 = Struct("<f")
+_u64 = Struct("<Q")
+_f64 = Struct("<d")
+
+# binary32 in the 64 bit f registers: upper half all ones, anything else
+# reads as the canonical NaN
+BOX = 0xffff_ffff_0000_0000
+
+
+class Format:
+    """binary32 or binary64 parameters and host conversions"""
+
+    __slots__ = ("width", "p", "fbits", "emask", "bias", "emin", "emax",
+        "sign", "frac_mask", "quiet", "inf", "max_finite", "nan", "to_host",
+        "from_host")
+
+    def __init__(self, width: int, ebits: int):
+        self.width = width
+        self.fbits = width-ebits-1
+        # precision, hidden bit included
+        self.p = self.fbits+1
+        self.emask = (1<<ebits)-1
+        self.bias = self.emask>>1
+        self.emin = 1-self.bias
+        self.emax = self.bias
+        self.sign = 1<<(width-1)
+        self.frac_mask = (1<<self.fbits)-1
+        self.quiet = 1<<(self.fbits-1)
+        self.inf = self.emask<<self.fbits
+        self.max_finite = self.inf-1
+        # canonical NaN
+        self.nan = self.inf | self.quiet
+        if width == 32:
+            self.to_host = _to_host_32
+            self.from_host = _from_host_32
+        else:
+            self.to_host = _to_host_64
+            self.from_host = _from_host_64
+
+def _to_host_32(bits: int) -> float:
+    return _f32.unpack(_u32.pack(bits))[0]
+
+def _to_host_64(bits: int) -> float:
+    return _f64.unpack(_u64.pack(bits))[0]
+
+def _from_host_32(x: float) -> int:
+    """
+    bits of x rounded to binary32 (nearest even), None unless it is normal
+    and above the smallest normal, which may have been rounded up from a
+    tiny result (an underflow)
+    """
+    try:
+        packed = _f32.pack(x)
+    except OverflowError:
+        return None
+    bits = _u32.unpack(packed)[0]
+    mag = bits & 0x7fff_ffff
+    if mag <= 0x0080_0000 or mag >= 0x7f80_0000:
+        return None
+    return bits
+
+def _from_host_64(x: float) -> int:
+    """bits of x, None unless it is normal and above the smallest normal"""
+    if not 2.2250738585072014e-308 < abs(x) <= 1.7976931348623157e+308:
+        return None
+    return _u64.unpack(_f64.pack(x))[0]
+
+F32 = Format(32, 8)
+F64 = Format(64, 11)
+
+def unbox(value: int) -> int:
+    """binary32 operand from a 64 bit f register"""
+    if value>>32 == 0xffff_ffff:
+        return value & 0xffff_ffff
+    return F32.nan
+
+# ------------------------------ EXACT CORE ---------------------------------- #
+
+def _unpack(fmt: Format, bits: int) -> Tuple[int, int, int, int]:
+    """(kind, sign, m, e), a finite value is (-1)**sign * m * 2**e"""
+    sign = bits>>(fmt.width-1)
+    exp = (bits>>fmt.fbits) & fmt.emask
+    frac = bits & fmt.frac_mask
+    if exp == fmt.emask:
+        return (NAN if frac else INF), sign, frac, 0
+    if exp == 0:
+        return FIN, sign, frac, fmt.emin-fmt.fbits
+    return FIN, sign, frac | (1<<fmt.fbits), exp-fmt.bias-fmt.fbits
+
+def _is_snan(fmt: Format, bits: int) -> bool:
+    return bits & fmt.inf == fmt.inf and bits & fmt.frac_mask \
+        and not bits & fmt.quiet
+
+def _nan(fmt: Format, *operands: int) -> Tuple[int, int]:
+    """canonical NaN, NV if any operand is a signaling NaN"""
+    for bits in operands:
+        if _is_snan(fmt, bits):
+            return fmt.nan, NV
+    return fmt.nan, 0
+
+def _shift_round(m: int, shift: int, sticky: bool, sign: int,
+        rm: int) -> Tuple[int, bool]:
+    """m>>shift rounded with rm, sticky: bits below m are not all zero"""
+    if shift <= 0:
+        return m<<-shift, sticky
+    q = m>>shift
+    rem = m & ((1<<shift)-1)
+    if not rem and not sticky:
+        return q, False
+    half = 1<<(shift-1)
+    if rm == RNE:
+        up = rem > half or (rem == half and (sticky or q & 1))
+    elif rm == RTZ:
+        up = False
+    elif rm == RDN:
+        up = sign
+    elif rm == RUP:
+        up = not sign
+    else: # RMM
+        up = rem >= half
+    return q+bool(up), True
+
+def _overflow(fmt: Format, sign: int, rm: int) -> int:
+    if rm == RNE or rm == RMM or (rm == RUP and not sign) \
+            or (rm == RDN and sign):
+        mag = fmt.inf
+    else:
+        mag = fmt.max_finite
+    return (fmt.sign if sign else 0) | mag
+
+def _round(fmt: Format, sign: int, m: int, e: int, sticky: bool,
+        rm: int) -> Tuple[int, int]:
+    """
+    bits and flags of (-1)**sign * (m+sticky) * 2**e. With sticky set, m
+    must carry at least p+2 bits so that the rounding point is inside m
+    """
+    sign_bit = fmt.sign if sign else 0
+    if not m:
+        return sign_bit, 0
+    p = fmt.p
+    exp = m.bit_length()-1+e
+    # tininess is detected after rounding: rounded to p bits with an
+    # unbounded exponent the result is still below the smallest normal
+    tiny = False
+    if exp < fmt.emin:
+        tiny = True
+        if exp == fmt.emin-1:
+            q, _ = _shift_round(m, exp-p+1-e, sticky, sign, rm)
+            tiny = not q>>p
+    # position of the result lsb, fixed in the subnormal range
+    lsb = max(exp, fmt.emin)-p+1
+    q, inexact = _shift_round(m, lsb-e, sticky, sign, rm)
+    if q>>p:
+        q >>= 1
+        lsb += 1
+    if q and lsb+q.bit_length()-1 > fmt.emax:
+        return _overflow(fmt, sign, rm), OF | NX
+
+    flags = 0
+    if inexact:
+        flags = NX | UF if tiny else NX
+    if q>>(p-1):
+        return sign_bit | ((lsb+p-1+fmt.bias)<<fmt.fbits) | (q & fmt.frac_mask),\
+            flags
+    # subnormal or zero
+    return sign_bit | q, flags
+
+def _exact_zero(sign_a: int, sign_b: int, rm: int) -> int:
+    """sign of an exact zero sum: -0 only for two -0 or when rounding down"""
+    if sign_a == sign_b:
+        return sign_a
+    return 1 if rm == RDN else 0
+
+def _sum(fmt: Format, sa: int, ma: int, ea: int, sb: int, mb: int, eb: int,
+        rm: int) -> Tuple[int, int]:
+    e = min(ea, eb)
+    a = ma<<(ea-e)
+    b = mb<<(eb-e)
+    v = (-a if sa else a) + (-b if sb else b)
+    if v == 0:
+        return (fmt.sign if _exact_zero(sa, sb, rm) else 0), 0
+    return _round(fmt, v < 0, abs(v), e, False, rm)
+
+# ------------------------------ OPERATIONS ---------------------------------- #
+
+def add(fmt: Format, a: int, b: int, rm: int, nx: int) -> Tuple[int, int]:
+    if rm == RNE and nx:
+        bits = fmt.from_host(fmt.to_host(a)+fmt.to_host(b))
+        if bits is not None:
+            return bits, 0
+    return _add(fmt, a, b, rm)
+
+def sub(fmt: Format, a: int, b: int, rm: int, nx: int) -> Tuple[int, int]:
+    if rm == RNE and nx:
+        bits = fmt.from_host(fmt.to_host(a)-fmt.to_host(b))
+        if bits is not None:
+            return bits, 0
+    return _add(fmt, a, b ^ fmt.sign, rm)
+
+def _add(fmt: Format, a: int, b: int, rm: int) -> Tuple[int, int]:
+    ka, sa, ma, ea = _unpack(fmt, a)
+    kb, sb, mb, eb = _unpack(fmt, b)
+    if ka == NAN or kb == NAN:
+        return _nan(fmt, a, b)
+    if ka == INF:
+        if kb == INF and sa != sb:
+            return fmt.nan, NV
+        return a, 0
+    if kb == INF:
+        return b, 0
+    return _sum(fmt, sa, ma, ea, sb, mb, eb, rm)
+
+def mul(fmt: Format, a: int, b: int, rm: int, nx: int) -> Tuple[int, int]:
+    if rm == RNE and nx:
+        bits = fmt.from_host(fmt.to_host(a)*fmt.to_host(b))
+        if bits is not None:
+            return bits, 0
+    ka, sa, ma, ea = _unpack(fmt, a)
+    kb, sb, mb, eb = _unpack(fmt, b)
+    if ka == NAN or kb == NAN:
+        return _nan(fmt, a, b)
+    sign = sa ^ sb
+    if ka == INF or kb == INF:
+        if (ka == FIN and not ma) or (kb == FIN and not mb):
+            return fmt.nan, NV
+        return (fmt.sign if sign else 0) | fmt.inf, 0
+    return _round(fmt, sign, ma*mb, ea+eb, False, rm)
+
+def div(fmt: Format, a: int, b: int, rm: int, nx: int) -> Tuple[int, int]:
+    if rm == RNE and nx:
+        y = fmt.to_host(b)
+        if y:
+            bits = fmt.from_host(fmt.to_host(a)/y)
+            if bits is not None:
+                return bits, 0
+    ka, sa, ma, ea = _unpack(fmt, a)
+    kb, sb, mb, eb = _unpack(fmt, b)
+    if ka == NAN or kb == NAN:
+        return _nan(fmt, a, b)
+    sign_bit = fmt.sign if sa ^ sb else 0
+    if ka == INF:
+        if kb == INF:
+            return fmt.nan, NV
+        return sign_bit | fmt.inf, 0
+    if kb == INF:
+        return sign_bit, 0
+    if not mb:
+        if not ma:
+            return fmt.nan, NV
+        return sign_bit | fmt.inf, DZ
+    if not ma:
+        return sign_bit, 0
+    # enough quotient bits for the rounding, the remainder is the sticky
+    k = max(0, fmt.p+3+mb.bit_length()-ma.bit_length())
+    q, r = divmod(ma<<k, mb)
+    return _round(fmt, sa ^ sb, q, ea-eb-k, r != 0, rm)
+
+def sqrt(fmt: Format, a: int, rm: int, nx: int) -> Tuple[int, int]:
+    if rm == RNE and nx:
+        x = fmt.to_host(a)
+        if x > 0:
+            bits = fmt.from_host(math.sqrt(x))
+            if bits is not None:
+                return bits, 0
+    ka, sa, ma, ea = _unpack(fmt, a)
+    if ka == NAN:
+        return _nan(fmt, a)
+    if ka == FIN and not ma:
+        return a, 0 # sqrt(-0) = -0
+    if sa:
+        return fmt.nan, NV
+    if ka == INF:
+        return a, 0
+    if ea & 1:
+        ma <<= 1
+        ea -= 1
+    # an even shift leaving 2*(p+3) bits under the square root
+    k = max(0, 2*(fmt.p+3)-ma.bit_length())
+    k += k & 1
+    ma <<= k
+    ea -= k
+    s = math.isqrt(ma)
+    return _round(fmt, 0, s, ea>>1, s*s != ma, rm)
+
+def fma(fmt: Format, a: int, b: int, c: int, rm: int, neg_prod: bool,
+        neg_add: bool) -> Tuple[int, int]:
+    """(-)(a*b) (+/-) c with a single rounding, always exact"""
+    ka, sa, ma, ea = _unpack(fmt, a)
+    kb, sb, mb, eb = _unpack(fmt, b)
+    kc, sc, mc, ec = _unpack(fmt, c)
+    # inf*0 is invalid even with a quiet NaN addend
+    inf_zero = (ka == INF and kb == FIN and not mb) or \
+        (kb == INF and ka == FIN and not ma)
+    if ka == NAN or kb == NAN or kc == NAN:
+        bits, flags = _nan(fmt, a, b, c)
+        return bits, flags | (NV if inf_zero else 0)
+    if inf_zero:
+        return fmt.nan, NV
+    sp = sa ^ sb ^ neg_prod
+    sc ^= neg_add
+    if ka == INF or kb == INF:
+        if kc == INF and sc != sp:
+            return fmt.nan, NV
+        return (fmt.sign if sp else 0) | fmt.inf, 0
+    if kc == INF:
+        return (fmt.sign if sc else 0) | fmt.inf, 0
+    return _sum(fmt, sp, ma*mb, ea+eb, sc, mc, ec, rm)
+
+def _key(fmt: Format, bits: int) -> int:
+    """total order of the non NaN values, with -0 < +0"""
+    if bits & fmt.sign:
+        return -(bits ^ fmt.sign)-1
+    return bits
+
+def _is_nan(fmt: Format, bits: int) -> bool:
+    return bits & fmt.inf == fmt.inf and bits & fmt.frac_mask != 0
+
+def minmax(fmt: Format, a: int, b: int, is_max: bool) -> Tuple[int, int]:
+    flags = NV if _is_snan(fmt, a) or _is_snan(fmt, b) else 0
+    if _is_nan(fmt, a):
+        return (fmt.nan if _is_nan(fmt, b) else b), flags
+    if _is_nan(fmt, b):
+        return a, flags
+    if (_key(fmt, a) < _key(fmt, b)) != is_max:
+        return a, flags
+    return b, flags
+
+def _cmp_key(fmt: Format, bits: int) -> int:
+    """order of the non NaN values, -0 == +0"""
+    if bits & fmt.sign:
+        return -(bits ^ fmt.sign)
+    return bits
+
+def feq(fmt: Format, a: int, b: int) -> Tuple[int, int]:
+    if _is_nan(fmt, a) or _is_nan(fmt, b):
+        return 0, (NV if _is_snan(fmt, a) or _is_snan(fmt, b) else 0)
+    return int(_cmp_key(fmt, a) == _cmp_key(fmt, b)), 0
+
+def flt(fmt: Format, a: int, b: int) -> Tuple[int, int]:
+    if _is_nan(fmt, a) or _is_nan(fmt, b):
+        return 0, NV
+    return int(_cmp_key(fmt, a) < _cmp_key(fmt, b)), 0
+
+def fle(fmt: Format, a: int, b: int) -> Tuple[int, int]:
+    if _is_nan(fmt, a) or _is_nan(fmt, b):
+        return 0, NV
+    return int(_cmp_key(fmt, a) <= _cmp_key(fmt, b)), 0
+
+def fclass(fmt: Format, a: int) -> int:
+    kind, sign, m, e = _unpack(fmt, a)
+    if kind == NAN:
+        return 1<<9 if a & fmt.quiet else 1<<8
+    if kind == INF:
+        return 1<<0 if sign else 1<<7
+    if not m:
+        return 1<<3 if sign else 1<<4
+    if not m>>fmt.fbits: # subnormal
+        return 1<<2 if sign else 1<<5
+    return 1<<1 if sign else 1<<6
+
+def to_int(fmt: Format, a: int, rm: int, signed: bool,
+        width: int) -> Tuple[int, int]:
+    """integer value of a (a python int, negative when signed), saturated"""
+    if signed:
+        lo, hi = -(1<<(width-1)), (1<<(width-1))-1
+    else:
+        lo, hi = 0, (1<<width)-1
+    if rm == RTZ:
+        # C casts, int() truncates; NaN and inf fail the range test
+        x = fmt.to_host(a)
+        if lo-1 < x < hi+1:
+            v = int(x)
+            return v, (NX if v != x else 0)
+    kind, sign, m, e = _unpack(fmt, a)
+    if kind == NAN:
+        return hi, NV
+    if kind == INF:
+        return (lo if sign else hi), NV
+    v, inexact = _shift_round(m, -e, False, sign, rm)
+    if sign:
+        v = -v
+    if v < lo or v > hi:
+        return (lo if sign else hi), NV
+    return v, (NX if inexact else 0)
+
+def from_int(fmt: Format, v: int, rm: int) -> Tuple[int, int]:
+    """v is a python int, any sign"""
+    if -(1<<fmt.p) < v < (1<<fmt.p):
+        # exactly representable
+        if not v:
+            return 0, 0
+        return fmt.from_host(float(v)), 0
+    return _round(fmt, v < 0, abs(v), 0, False, rm)
+
+def convert(src: Format, dst: Format, a: int, rm: int,
+        nx: int) -> Tuple[int, int]:
+    """fcvt.s.d and fcvt.d.s"""
+    kind, sign, m, e = _unpack(src, a)
+    if kind == NAN:
+        return dst.nan, (NV if _is_snan(src, a) else 0)
+    if kind == INF:
+        return (dst.sign if sign else 0) | dst.inf, 0
+    if src.p < dst.p or (rm == RNE and nx):
+        bits = dst.from_host(src.to_host(a))
+        if bits is not None:
+            return bits, 0
+    return _round(dst, sign, m, e, False, rm)
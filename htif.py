@@ -0,0 +1,117 @@
+"""
+Berkeley Host-Target Interface: the tohost/fromhost pair used by the
+riscv-tests and the proxy kernel to exit and to print. Registered as an
+overlay on the RAM at the `tohost` symbol, e.g.
+
+    htif = HtifDevice(sys_bus, fromhost_offset=elf.fromhost-elf.tohost)
+    sys_bus.register_device(htif, elf.tohost, overlay=True)
+
+A tohost write is decoded as device (63:56), command (55:48) and payload,
+once the write covering byte 7 (the high word on RV32) is done:
+
+    dev 0 cmd 0, payload&1   exit with code payload>>1
+    dev 0 cmd 0              syscall, payload is the address of the 8 words
+                             [num, arg0, arg1, ...], the result goes in num
+    dev 1 cmd 1              putchar(payload&0xff)
+
+The exit write returns False, which stops the hart without any check on
+the store path. Console output goes through a buffered host writer that
+is flushed on exit.
+"""
+import logging
+import sys
+from typing import BinaryIO, Dict
+
+from devices import BaseDevice
+from system_interface import SystemInterface
+
+log = logging.getLogger(__name__)
+
+SYS_WRITE = 64
+SYS_EXIT = 93
+ENOSYS = 38
+MASK64 = (1<<64)-1
+PAYLOAD_MASK = (1<<48)-1
+
+
+class HtifDevice(BaseDevice):
+
+    def __init__(self,
+            sys_bus: SystemInterface,
+            fromhost_offset: int = 0x40,
+            out: BinaryIO = None,
+            name="HTIF"):
+        super().__init__(fromhost_offset+8, name)
+        self.sys_bus = sys_bus
+        self.fromhost_offset : int = fromhost_offset
+        self.out : BinaryIO = out if out is not None else sys.stdout.buffer
+        self.exit_code : int = None
+
+    def write(self, addr: int, value: int, size: int = 4):
+        super().write(addr, value, size)
+        # the command runs on the write covering the top byte of tohost: a 32
+        # bit target writes the low word first and then the high one, which
+        # holds dev and cmd
+        if addr < 8 <= addr+size:
+            cmd = self.read(0, 8)
+            if cmd:
+                return self.command(cmd)
+
+    def command(self, cmd: int):
+        dev, op, payload = cmd>>56, (cmd>>48)&0xff, cmd&PAYLOAD_MASK
+
+        if dev == 0 and op == 0:
+            if payload & 1:
+                return self.exit(payload>>1)
+            if self.syscall(payload) is False:
+                return False
+            self.ack(1)
+        elif dev == 1 and op == 1:
+            self.out.write(bytes((payload&0xff,)))
+            self.ack((1<<56)|(1<<48))
+        else:
+            log.warning(f"{self.name}: unknown command 0x{cmd:016X}")
+            self.ack(cmd)
+
+    def ack(self, value: int):
+        super().write(0, 0, 8)
+        super().write(self.fromhost_offset, value, 8)
+
+    def exit(self, code: int):
+        self.exit_code = code
+        self.out.flush()
+        log.info(f"{self.name}: exit {code}")
+        return False
+
+    def syscall(self, addr: int):
+        bus = self.sys_bus
+        num, a0, a1, a2 = [bus.read(addr+8*i, 8) for i in range(4)]
+
+        if num == SYS_WRITE:
+            # a0 is the target fd, stdout and stderr both go to `out`
+            self.out.write(self.read_guest(a1, a2))
+            ret = a2
+        elif num == SYS_EXIT:
+            return self.exit(a0)
+        else:
+            log.warning(f"{self.name}: syscall {num} not implemented")
+            ret = -ENOSYS
+        bus.write(addr, ret&MASK64, 8)
+
+    def read_guest(self, addr: int, n: int) -> bytes:
+        bus = self.sys_bus
+        data = bytearray()
+        end = addr+n
+        while addr+8 <= end:
+            data += bus.read(addr, 8).to_bytes(8, "little")
+            addr += 8
+        while addr < end:
+            data.append(bus.read(addr, 1))
+            addr += 1
+        return bytes(data)
+
+    def get_state(self) -> Dict:
+        return {"exit_code": self.exit_code}
+
+    def set_state(self, state: Dict):
+        self.exit_code = state["exit_code"]
@@ -0,0 +1,292 @@
+"""
+Sv39/Sv48 (Sv32 on RV32) address translation between the hart and 
+SystemInterface.
+
+The hart never calls the MMU when translation is off: it fetches, loads
+and stores through its `fetch`, `mem_read` and `mem_write` attributes,
+which update() points either straight to the bus or to the MMU methods.
+
+Translated accesses go through three software TLBs, dicts from virtual
+page number to physical page base: the ITLB (fetch) and the DTLB split in
+a read and a write half. An entry is only filled for an access that is
+allowed in the current context (privilege, SUM, MXR) with A (and D for
+the write half) already set in the PTE, so a hit needs no check at all.
+The TLBs of each context are kept apart and all of them are flushed by
+sfence.vma and satp writes.
+"""
+import logging
+from typing import Dict, Tuple
+
+from cpu_enums import *
+from devices import PAGE_SHIFT, PAGE_SIZE, PAGE_MASK
+from system_interface import BusError
+
+log = logging.getLogger(__name__)
+
+PTE_V, PTE_R, PTE_W, PTE_X, PTE_U, PTE_G, PTE_A, PTE_D = (1<<i for i in range(8))
+PTE_PPN_MASK = (1<<44)-1
+# N, PBMT and reserved bits, must be zero without Svnapot/Svpbmt
+PTE_RESERVED = ((1<<10)-1)<<54
+SV32_PPN_MASK = (1<<22)-1
+
+SATP = CSR_S["satp"][0]
+MSTATUS = CSR_M["mstatus"][0]
+M_MODE, S_MODE, U_MODE = Mode.M.value, Mode.S.value, Mode.U.value
+
+# page table levels by satp.MODE
+LEVELS = {SATP_SV39: 3, SATP_SV48: 4}
+SV32_LEVELS = {SATP32_SV32: 2}
+
+FETCH, LOAD, STORE = 0, 1, 2
+PAGE_FAULT = {
+    FETCH : ExceptionCode.InstructionPageFault,
+    LOAD : ExceptionCode.LoadPageFault,
+    STORE : ExceptionCode.StoreAmoPageFault,
+}
+ACCESS_FAULT = {
+    FETCH : ExceptionCode.InstructionAccessFault,
+    LOAD : ExceptionCode.LoadAccessFault,
+    STORE : ExceptionCode.StoreAmoAccessFault,
+}
+
+
+class Trap(Exception):
+    """synchronous exception raised in the middle of an instruction"""
+
+    def __init__(self, code: ExceptionCode, tval: int = 0):
+        super().__init__(code, tval)
+        self.code = code
+        self.tval = tval
+
+
+class Mmu:
+
+    __slots__ = ("hart", "bus", "regs", "levels", "root", "priv_i", "priv_d",
+        "sum", "mxr", "active", "data_on", "itlb", "rtlb", "wtlb", "itlbs", 
+        "dtlbs", "sv32", "vpn_bits", "pte_size")
+
+    def __init__(self, hart):
+        self.hart = hart
+        self.bus = hart.sys_bus
+        self.regs = hart.csr.regs
+        # Sv32: 10 bit VPNs, 4 byte PTEs and a 1 bit satp.MODE
+        self.sv32 : bool = hart.xlen == 32
+        self.vpn_bits : int = 10 if self.sv32 else 9
+        self.pte_size : int = 4 if self.sv32 else 8
+
+        self.levels : int = None
+        self.root : int = 0
+        self.priv_i : int = M_MODE
+        self.priv_d : int = M_MODE
+        self.sum : int = 0
+        self.mxr : int = 0
+        # fetch or data translation on, run_blocks() only runs untranslated
+        self.active : bool = False
+        self.data_on : bool = False
+
+        # TLBs of the current context, and of every context seen since the
+        # last flush: ITLB by privilege, DTLB by (privilege, SUM, MXR)
+        self.itlb : Dict[int, int] = {}
+        self.rtlb : Dict[int, int] = {}
+        self.wtlb : Dict[int, int] = {}
+        self.itlbs : Dict[int, Dict[int, int]] = {}
+        self.dtlbs : Dict[Tuple, Tuple[Dict[int, int], Dict[int, int]]] = {}
+
+    def update(self):
+        """
+        re-evaluate the translation context after a change of privilege,
+        mstatus or satp, and point the hart accessors to the bus or the MMU
+        """
+        hart = self.hart
+        bus = self.bus
+        satp = self.regs[SATP]
+        mstatus = self.regs[MSTATUS]
+
+        if self.sv32:
+            self.levels = SV32_LEVELS.get(satp>>31)
+            self.root = (satp & SV32_PPN_MASK)<<PAGE_SHIFT
+        else:
+            self.levels = LEVELS.get(satp>>60)
+            self.root = (satp & PTE_PPN_MASK)<<PAGE_SHIFT
+        mode = hart.mode.value
+        # MPRV: M-mode loads and stores use the privilege in MPP
+        self.priv_i = mode
+        self.priv_d = (mstatus>>11) & 0b11 \
+            if mode == M_MODE and (mstatus>>17) & 1 else mode
+        self.sum = (mstatus>>18) & 1
+        self.mxr = (mstatus>>19) & 1
+
+        fetch_on = self.levels is not None and self.priv_i != M_MODE
+        data_on = self.levels is not None and self.priv_d != M_MODE
+        self.active = fetch_on or data_on
+        self.data_on = data_on
+
+        if fetch_on:
+            self.itlb = self.itlbs.setdefault(self.priv_i, {})
+            hart.fetch = self.fetch
+            # decoded instructions are cached by virtual pc in this context
+            hart.decode_cache = hart.decode_caches.setdefault(self.priv_i, {})
+        else:
+            hart.fetch = bus.read
+            hart.decode_cache = hart.decode_caches[None]
+
+        if data_on:
+            self.rtlb, self.wtlb = self.dtlbs.setdefault(
+                (self.priv_d, self.sum, self.mxr), ({}, {}))
+            hart.mem_read = self.read
+            hart.mem_write = self.write
+        else:
+            hart.mem_read = bus.read
+            hart.mem_write = bus.write
+
+    def flush(self):
+        """sfence.vma/satp write: drop every translation"""
+        for tlb in self.itlbs.values():
+            tlb.clear()
+        for rtlb, wtlb in self.dtlbs.values():
+            rtlb.clear()
+            wtlb.clear()
+        for key, cache in self.hart.decode_caches.items():
+            if key is not None:
+                cache.clear()
+
+    # ----------------------------- ACCESS ----------------------------------- #
+
+    def fetch(self, vaddr: int, size: int = 4) -> int:
+        page = self.itlb.get(vaddr>>PAGE_SHIFT)
+        if page is None or (vaddr & PAGE_MASK)+size > PAGE_SIZE:
+            return self._access_slow(vaddr, size, FETCH)
+        try:
+            return self.bus.read(page | (vaddr & PAGE_MASK), size)
+        except BusError:
+            raise Trap(ACCESS_FAULT[FETCH], vaddr)
+
+    def read(self, vaddr: int, size: int = 4) -> int:
+        page = self.rtlb.get(vaddr>>PAGE_SHIFT)
+        if page is None or (vaddr & PAGE_MASK)+size > PAGE_SIZE:
+            return self._access_slow(vaddr, size, LOAD)
+        try:
+            return self.bus.read(page | (vaddr & PAGE_MASK), size)
+        except BusError:
+            raise Trap(ACCESS_FAULT[LOAD], vaddr)
+
+    def write(self, vaddr: int, value: int, size: int = 4):
+        page = self.wtlb.get(vaddr>>PAGE_SHIFT)
+        if page is None or (vaddr & PAGE_MASK)+size > PAGE_SIZE:
+            return self._access_slow(vaddr, size, STORE, value)
+        try:
+            return self.bus.write(page | (vaddr & PAGE_MASK), value, size)
+        except BusError:
+            raise Trap(ACCESS_FAULT[STORE], vaddr)
+
+    def paddr(self, vaddr: int, access: int) -> int:
+        """physical address of an aligned data access (LR/SC, AMOs)"""
+        if not self.data_on:
+            return vaddr
+        tlb = self.wtlb if access == STORE else self.rtlb
+        page = tlb.get(vaddr>>PAGE_SHIFT)
+        if page is None:
+            page = self.translate(vaddr, access)
+        return page | (vaddr & PAGE_MASK)
+    
+    def _access_slow(self, vaddr: int, size: int, access: int, value: int = 0):
+        try:
+            return self._access_pages(vaddr, size, access, value)
+        except BusError:
+            raise Trap(ACCESS_FAULT[access], vaddr)
+
+    def _access_pages(self, vaddr: int, size: int, access: int, value: int):
+        if (vaddr & PAGE_MASK)+size > PAGE_SIZE:
+            # crossing a page: both pages are translated before any byte is
+            # written, then byte by byte
+            first = self.translate(vaddr, access)
+            second = self.translate(vaddr+size-1, access)
+            result = 0
+            for i in range(size):
+                va = vaddr+i
+                page = first if va>>PAGE_SHIFT == vaddr>>PAGE_SHIFT else second
+                pa = page | (va & PAGE_MASK)
+                if access == STORE:
+                    self.bus.write(pa, (value>>(8*i)) & 0xff, 1)
+                else:
+                    result |= self.bus.read(pa, 1)<<(8*i)
+            return None if access == STORE else result
+
+        pa = self.translate(vaddr, access) | (vaddr & PAGE_MASK)
+        if access == STORE:
+            return self.bus.write(pa, value, size)
+        return self.bus.read(pa, size)
+
+    # ---------------------------- PAGE WALK --------------------------------- #
+
+    def translate(self, vaddr: int, access: int) -> int:
+        """page walk for vaddr, fills the TLB and returns the page base"""
+        levels = self.levels
+        vpn_bits = self.vpn_bits
+        pte_size = self.pte_size
+        fault = PAGE_FAULT[access]
+
+        # the bits above the virtual address must all be equal to its msb
+        # (Sv32 uses all the 32 bits)
+        if not self.sv32:
+            top = vaddr>>(PAGE_SHIFT+9*levels-1)
+            if top != 0 and top != (1<<(64-PAGE_SHIFT-9*levels+1))-1:
+                raise Trap(fault, vaddr)
+
+        bus = self.bus
+        table = self.root
+        level = levels-1
+        vpn_mask = (1<<vpn_bits)-1
+        while True:
+            pte_addr = table + \
+                ((vaddr>>(PAGE_SHIFT+vpn_bits*level)) & vpn_mask)*pte_size
+            try:
+                pte = bus.read(pte_addr, pte_size)
+            except BusError:
+                raise Trap(ACCESS_FAULT[access], vaddr)
+            if not pte & PTE_V or pte & (PTE_R|PTE_W) == PTE_W \
+                    or pte & PTE_RESERVED:
+                raise Trap(fault, vaddr)
+            if pte & (PTE_R|PTE_X):
+                break
+            level -= 1
+            if level < 0:
+                raise Trap(fault, vaddr)
+            table = ((pte>>10) & PTE_PPN_MASK)<<PAGE_SHIFT
+
+        ppn = (pte>>10) & PTE_PPN_MASK
+        low = (1<<(vpn_bits*level))-1
+        # misaligned superpage
+        if ppn & low:
+            raise Trap(fault, vaddr)
+
+        priv = self.priv_i if access == FETCH else self.priv_d
+        if pte & PTE_U:
+            if priv == S_MODE and (access == FETCH or not self.sum):
+                raise Trap(fault, vaddr)
+        elif priv == U_MODE:
+            raise Trap(fault, vaddr)
+
+        if access == FETCH:
+            allowed = pte & PTE_X
+        elif access == LOAD:
+            allowed = pte & PTE_R or (self.mxr and pte & PTE_X)
+        else:
+            allowed = pte & PTE_W
+        if not allowed:
+            raise Trap(fault, vaddr)
+
+        # A and D are updated by the walk (Svadu), not trapped
+        new_pte = pte | PTE_A | (PTE_D if access == STORE else 0)
+        if new_pte != pte:
+            bus.write(pte_addr, new_pte, pte_size)
+
+        vpn = vaddr>>PAGE_SHIFT
+        page = (ppn | (vpn & low))<<PAGE_SHIFT
+        if access == FETCH:
+            self.itlb[vpn] = page
+        elif access == LOAD:
+            self.rtlb[vpn] = page
+        else:
+            self.wtlb[vpn] = page
+        return page
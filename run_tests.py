@@ -0,0 +1,224 @@
+"""
+Conformance runner for the riscv-tests executables in tests/rv32/elf and 
+tests/rv64/elf, loaded with ElfFile (segments, entry point and tohost).
+
+Every test runs in its own worker process with an instruction budget and a
+wall clock timeout, results can be written as JSON and JUnit XML, e.g.
+
+    python run_tests.py
+    python run_tests.py -j 8 --json results.json --junit results.xml
+    python run_tests.py "rv64ui-p-*" "rv64um-*"
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from fnmatch import fnmatch
+from pathlib import Path
+from typing import Dict, List
+
+from logger_config import setup_logging
+from utils import COL
+
+TESTS_DIR = Path(__file__).parent/"tests"
+RAM_BASE = 0x8000_0000
+RAM_SIZE = 64<<20
+
+MAX_INSTRET = 5_000_000
+TIMEOUT = 60.0
+# instructions run between two checks of the timeout
+CHUNK = 10_000
+
+PASS, FAIL, ERROR, TIMEOUT_, BUDGET, SKIP = \
+    "pass", "fail", "error", "timeout", "budget", "skipped"
+
+
+def discover(patterns: List[str] = None) -> List[Path]:
+    """every tests/rv*/elf/{p,v}/* matching one of the name patterns"""
+    tests = sorted(TESTS_DIR.glob("rv*/elf/[pv]/*"))
+    if patterns:
+        tests = [t for t in tests if any(fnmatch(t.stem, p) for p in patterns)]
+    return tests
+
+
+def run_test(path: Path, max_instret: int = MAX_INSTRET,
+        timeout: float = TIMEOUT, mode: str = "step") -> Dict:
+    """run a single test binary, the returned dict is json serializable"""
+
+    result = {
+        "name" : path.stem,
+        "suite" : path.parent.parent.parent.name,
+        "path" : str(path),
+        "status" : None,
+        "instret" : 0,
+        "time" : 0.0,
+        "message" : "",
+    }
+
+    # imported here so that the parent process does not need the hart
+    from clint import ClintDevice, CLINT_BASE
+    from cpu_enums import Ext
+    from devices import SparseMemoryDevice
+    from elf_loader import ElfFile
+    from htif import HtifDevice
+    from system_interface import SystemInterface
+    from main import RV64Hart
+    from rv32 import RV32Hart
+
+    start = time.perf_counter()
+    deadline = start+timeout
+    try:
+        elf = ElfFile(path)
+        sys_bus = SystemInterface()
+        sys_bus.register_device(SparseMemoryDevice(RAM_SIZE, "RAM"), RAM_BASE)
+        htif = HtifDevice(sys_bus, elf.fromhost-elf.tohost)
+        sys_bus.register_device(htif, elf.tohost, overlay=True)
+        clint = ClintDevice()
+        sys_bus.register_device(clint, CLINT_BASE)
+        elf.load(sys_bus)
+        hart_cls = RV32Hart if elf.xlen == 32 else RV64Hart
+        hart = hart_cls(0, sys_bus, 
+            [Ext.A, Ext.B, Ext.C, Ext.F, Ext.D, Ext.S, Ext.U], 
+            entry_point=elf.entry)
+        clint.attach(hart)
+
+        instret = 0
+        running = True
+        while running:
+            if instret>=max_instret:
+                result["status"] = BUDGET
+                result["message"] = f"no exit after {instret} instructions"
+                break
+            if time.perf_counter()>deadline:
+                result["status"] = TIMEOUT_
+                result["message"] = f"no exit after {timeout}s"
+                break
+
+            chunk = min(CHUNK, max_instret-instret)
+            if mode == "blocks":
+                n = hart.run_blocks(chunk)
+                running = not hart.terminate
+            else:
+                n = hart.run_steps(chunk)
+                running = not hart.terminate
+            instret += n
+
+        result["instret"] = instret
+        if result["status"] is None:
+            # riscv-tests exit with 0 or the number of the failed case
+            if htif.exit_code == 0:
+                result["status"] = PASS
+            elif htif.exit_code is not None:
+                result["status"] = FAIL
+                result["message"] = f"failed test case {htif.exit_code}"
+            else:
+                result["status"] = FAIL
+                result["message"] = f"halted at pc 0x{hart.pc:08X} "\
+                    f"without exit"
+    except Exception as e:
+        result["status"] = ERROR
+        result["message"] = f"{type(e).__name__}: {e}"
+
+    result["time"] = time.perf_counter()-start
+    return result
+
+
+def _worker_init(verbose: bool):
+    if verbose:
+        setup_logging(logging.DEBUG)
+    else:
+        logging.disable(logging.CRITICAL)
+
+
+# ---------------------------------------------------------------------------- #
+
+def write_json(results: List[Dict], filepath: str):
+    with open(filepath, "w") as f:
+        json.dump(results, f, indent=2)
+
+def write_junit(results: List[Dict], filepath: str):
+    root = ET.Element("testsuites")
+    for suite in sorted({r["suite"] for r in results}):
+        cases = [r for r in results if r["suite"] == suite]
+        ts = ET.SubElement(root, "testsuite", name=suite,
+            tests=str(len(cases)),
+            failures=str(sum(r["status"] in (FAIL, BUDGET, TIMEOUT_)
+                for r in cases)),
+            errors=str(sum(r["status"] == ERROR for r in cases)),
+            skipped=str(sum(r["status"] == SKIP for r in cases)),
+            time=f"{sum(r['time'] for r in cases):.3f}")
+        for r in cases:
+            tc = ET.SubElement(ts, "testcase", classname=suite, name=r["name"],
+                time=f"{r['time']:.3f}")
+            ET.SubElement(tc, "property", name="instret", value=str(r["instret"]))
+            if r["status"] in (FAIL, BUDGET, TIMEOUT_):
+                ET.SubElement(tc, "failure", type=r["status"],
+                    message=r["message"])
+            elif r["status"] == ERROR:
+                ET.SubElement(tc, "error", message=r["message"])
+            elif r["status"] == SKIP:
+                ET.SubElement(tc, "skipped", message=r["message"])
+    ET.indent(root)
+    ET.ElementTree(root).write(filepath, encoding="utf-8", xml_declaration=True)
+
+STATUS_COL = {PASS: "g", FAIL: "r", ERROR: "r", TIMEOUT_: "y", BUDGET: "y",
+    SKIP: "gr"}
+
+def print_result(r: Dict):
+    col = COL[STATUS_COL[r["status"]]]
+    print(f"{r['name']:<28s} {col}{r['status']:<8s}{COL['rst']} "\
+        f"{r['instret']:>10d} {r['time']:>7.2f}s  {r['message']}", flush=True)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("patterns", nargs="*",
+        help="test name patterns, e.g. 'rv64ui-p-*' (default: all)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+        help="worker processes")
+    parser.add_argument("--max-instret", type=int, default=MAX_INSTRET,
+        help="instruction budget per test")
+    parser.add_argument("--timeout", type=float, default=TIMEOUT,
+        help="wall clock budget per test in seconds")
+    parser.add_argument("--mode", choices=["step", "blocks"], default="step")
+    parser.add_argument("--json", metavar="FILE", help="write results as json")
+    parser.add_argument("--junit", metavar="FILE", help="write JUnit xml")
+    parser.add_argument("-v", "--verbose", action="store_true",
+        help="keep the simulator logging on")
+    args = parser.parse_args()
+
+    tests = discover(args.patterns)
+    if not tests:
+        print("no test found")
+        return 1
+
+    start = time.perf_counter()
+    results : List[Dict] = []
+    with ProcessPoolExecutor(args.jobs, initializer=_worker_init,
+            initargs=(args.verbose,)) as pool:
+        futures = [pool.submit(run_test, t, args.max_instret, args.timeout,
+            args.mode) for t in tests]
+        for future in as_completed(futures):
+            results.append(future.result())
+            print_result(results[-1])
+    elapsed = time.perf_counter()-start
+
+    results.sort(key=lambda r: (r["suite"], r["name"]))
+    if args.json:
+        write_json(results, args.json)
+    if args.junit:
+        write_junit(results, args.junit)
+
+    count = {s: sum(r["status"] == s for r in results) for s in STATUS_COL}
+    instret = sum(r["instret"] for r in results)
+    print(f"\n{len(results)} tests in {elapsed:.1f}s, {instret} instructions: "\
+        + ", ".join(f"{n} {s}" for s, n in count.items() if n))
+
+    return 0 if count[PASS]+count[SKIP] == len(results) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
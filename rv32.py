@@ -0,0 +1,431 @@
+"""
+RV32 hart: the RV64Hart decode and dispatch with handlers specialized for
+XLEN=32.
+
+The register values are unsigned 32 bit ints. Only the handlers whose
+result depends on XLEN are redefined, with the 32 bit masks, sign bit and
+shift widths written in, the others (and, or, xor, sltu, lui, the CSR and
+most FP ones...) are shared with RV64Hart. The dispatch tables are the
+RV64 ones without the RV64-only encodings (OP_32/OP_IMM_32, LD/LWU/SD,
+the .D AMOs and shamt[5]) and with every handler replaced by its RV32
+version. Block translation is RV64 only, RV32 runs through step().
+"""
+import logging
+
+from cpu_enums import *
+from decoder import Decoded, MASK32, SIGN32
+from main import RV64Hart, AMO_OPS, ORC_B_TABLE, MSTATUS_FS, MSTATUS_ADDR, \
+    FCSR_ADDR
+from mmu import Trap, LOAD, STORE
+from rvc import RVC32_TABLE
+from utils import clmul
+import fpu
+from fpu import F32, F64, BOX, unbox
+
+log = logging.getLogger(__name__)
+
+
+class RV32Hart(RV64Hart):
+
+    __slots__ = ()
+
+    xlen = 32
+    mstatus_sd = 1<<31
+    fp_dirty = MSTATUS_FS | mstatus_sd
+    rvc_table = RVC32_TABLE
+
+    def decode_at(self, pc: int) -> Decoded:
+        d = super().decode_at(pc)
+        # the immediates are sign extended to 32 bit
+        d.imm &= MASK32
+        return d
+
+    # ---------------------------- HANDLERS ---------------------------------- #
+
+    def _exec_jal(self, d: Decoded):
+        self.regfile.reg_file[d.rd] = self.new_pc
+        self.new_pc = (self.pc + d.imm) & MASK32
+
+    def _exec_j(self, d: Decoded): # JAL with rd=x0
+        self.new_pc = (self.pc + d.imm) & MASK32
+
+    def _exec_jalr(self, d: Decoded):
+        x = self.regfile.reg_file
+        self.new_pc, x[d.rd] = (x[d.rs1] + d.imm) & (MASK32-1), self.new_pc
+
+    def _exec_jr(self, d: Decoded): # JALR with rd=x0
+        self.new_pc = (self.regfile.reg_file[d.rs1] + d.imm) & (MASK32-1)
+
+    # OP -------------------------------------------------------------------- #
+
+    def _exec_add(self, d: Decoded):
+        x = self.regfile.reg_file
+        x[d.rd] = (x[d.rs1] + x[d.rs2]) & MASK32
+
+    def _exec_sub(self, d: Decoded):
+        x = self.regfile.reg_file
+        x[d.rd] = (x[d.rs1] - x[d.rs2]) & MASK32
+
+    def _exec_sll(self, d: Decoded):
+        x = self.regfile.reg_file
+        x[d.rd] = (x[d.rs1] << (x[d.rs2] & 0x1f)) & MASK32
+
+    def _exec_slt(self, d: Decoded):
+        x = self.regfile.reg_file
+        x[d.rd] = int((x[d.rs1] ^ SIGN32) < (x[d.rs2] ^ SIGN32))
+
+    def _exec_srl(self, d: Decoded):
+        x = self.regfile.reg_file
+        x[d.rd] = x[d.rs1] >> (x[d.rs2] & 0x1f)
+
+    def _exec_sra(self, d: Decoded):
+        x = self.regfile.reg_file
+        x[d.rd] = (((x[d.rs1] ^ SIGN32) - SIGN32) >> (x[d.rs2] & 0x1f)) & MASK32
+
+    # M --------------------------------------------------------------------- #
+
+    def _exec_mul(self, d: Decoded):
+        x = self.regfile.reg_file
+        x[d.rd] = (x[d.rs1] * x[d.rs2]) & MASK32
+
+    def _exec_mulh(self, d: Decoded):
+        x = self.regfile.reg_file
+        x[d.rd] = ((((x[d.rs1] ^ SIGN32) - SIGN32) * \
+            ((x[d.rs2] ^ SIGN32) - SIGN32)) >> 32) & MASK32
+
+    def _exec_mulhsu(self, d: Decoded):
+        x = self.regfile.reg_file
+        x[d.rd] = ((((x[d.rs1] ^ SIGN32) - SIGN32) * x[d.rs2]) >> 32) & MASK32
+
+    def _exec_mulhu(self, d: Decoded):
+        x = self.regfile.reg_file
+        x[d.rd] = (x[d.rs1] * x[d.rs2]) >> 32
+
+    def _exec_div(self, d: Decoded):
+        x = self.regfile.reg_file
+        a, b = x[d.rs1], x[d.rs2]
+        if b == 0:
+            x[d.rd] = MASK32
+        elif a < SIGN32 and b < SIGN32:
+            x[d.rd] = a // b
+        else:
+            a, b = (a ^ SIGN32) - SIGN32, (b ^ SIGN32) - SIGN32
+            q = abs(a) // abs(b)
+            x[d.rd] = (-q if (a < 0) != (b < 0) else q) & MASK32
+
+    def _exec_divu(self, d: Decoded):
+        x = self.regfile.reg_file
+        b = x[d.rs2]
+        x[d.rd] = x[d.rs1] // b if b else MASK32
+
+    def _exec_rem(self, d: Decoded):
+        x = self.regfile.reg_file
+        a, b = x[d.rs1], x[d.rs2]
+        if b == 0:
+            x[d.rd] = a
+        elif a < SIGN32 and b < SIGN32:
+            x[d.rd] = a % b
+        else:
+            a, b = (a ^ SIGN32) - SIGN32, (b ^ SIGN32) - SIGN32
+            r = abs(a) % abs(b)
+            x[d.rd] = (-r if a < 0 else r) & MASK32
+
+    # OP_IMM ---------------------------------------------------------------- #
+    # shamt[5]=1 is reserved, those encodings are not in the tables
+
+    def _exec_addi(self, d: Decoded):
+        x = self.regfile.reg_file
+        x[d.rd] = (x[d.rs1] + d.imm) & MASK32
+
+    def _exec_slli(self, d: Decoded):
+        x = self.regfile.reg_file
+        x[d.rd] = (x[d.rs1] << (d.imm & 0x1f)) & MASK32
+
+    def _exec_slti(self, d: Decoded):
+        x = self.regfile.reg_file
+        x[d.rd] = int((x[d.rs1] ^ SIGN32) < (d.imm ^ SIGN32))
+
+    def _exec_srai(self, d: Decoded):
+        x = self.regfile.reg_file
+        x[d.rd] = (((x[d.rs1] ^ SIGN32) - SIGN32) >> (d.imm & 0x1f)) & MASK32
+
+    # Zb* ------------------------------------------------------------------- #
+
+    def _exec_shadd(self, d: Decoded): # SH1ADD, SH2ADD, SH3ADD
+        x = self.regfile.reg_file
+        x[d.rd] = ((x[d.rs1] << (d.f3>>1)) + x[d.rs2]) & MASK32
+
+    def _exec_orn(self, d: Decoded):
+        x = self.regfile.reg_file
+        x[d.rd] = (x[d.rs1] | ~x[d.rs2]) & MASK32
+
+    def _exec_xnor(self, d: Decoded):
+        x = self.regfile.reg_file
+        x[d.rd] = ~(x[d.rs1] ^ x[d.rs2]) & MASK32
+
+    def _exec_min(self, d: Decoded):
+        x = self.regfile.reg_file
+        a, b = x[d.rs1], x[d.rs2]
+        x[d.rd] = a if (a ^ SIGN32) < (b ^ SIGN32) else b
+
+    def _exec_max(self, d: Decoded):
+        x = self.regfile.reg_file
+        a, b = x[d.rs1], x[d.rs2]
+        x[d.rd] = a if (a ^ SIGN32) > (b ^ SIGN32) else b
+
+    def _exec_rol(self, d: Decoded):
+        x = self.regfile.reg_file
+        a, sh = x[d.rs1], x[d.rs2] & 0x1f
+        x[d.rd] = ((a << sh) | (a >> (32-sh))) & MASK32
+
+    def _exec_ror(self, d: Decoded):
+        x = self.regfile.reg_file
+        a, sh = x[d.rs1], x[d.rs2] & 0x1f
+        x[d.rd] = ((a >> sh) | (a << (32-sh))) & MASK32
+
+    def _exec_rori(self, d: Decoded):
+        x = self.regfile.reg_file
+        a, sh = x[d.rs1], d.imm & 0x1f
+        x[d.rd] = ((a >> sh) | (a << (32-sh))) & MASK32
+
+    def _exec_clz(self, d: Decoded):
+        x = self.regfile.reg_file
+        x[d.rd] = 32 - x[d.rs1].bit_length()
+
+    def _exec_ctz(self, d: Decoded):
+        x = self.regfile.reg_file
+        a = x[d.rs1]
+        x[d.rd] = (a & -a).bit_length()-1 if a else 32
+
+    def _exec_sext_b(self, d: Decoded):
+        x = self.regfile.reg_file
+        x[d.rd] = (((x[d.rs1] & 0xff) ^ 0x80) - 0x80) & MASK32
+
+    def _exec_sext_h(self, d: Decoded):
+        x = self.regfile.reg_file
+        x[d.rd] = (((x[d.rs1] & 0xffff) ^ 0x8000) - 0x8000) & MASK32
+
+    def _exec_rev8(self, d: Decoded):
+        x = self.regfile.reg_file
+        x[d.rd] = int.from_bytes(x[d.rs1].to_bytes(4, "little"), "big")
+
+    def _exec_orc_b(self, d: Decoded):
+        x = self.regfile.reg_file
+        x[d.rd] = int.from_bytes(
+            x[d.rs1].to_bytes(4, "little").translate(ORC_B_TABLE), "little")
+
+    def _exec_clmul(self, d: Decoded):
+        x = self.regfile.reg_file
+        x[d.rd] = clmul(x[d.rs1], x[d.rs2]) & MASK32
+
+    def _exec_clmulh(self, d: Decoded):
+        x = self.regfile.reg_file
+        x[d.rd] = clmul(x[d.rs1], x[d.rs2]) >> 32
+
+    def _exec_clmulr(self, d: Decoded):
+        x = self.regfile.reg_file
+        x[d.rd] = (clmul(x[d.rs1], x[d.rs2]) >> 31) & MASK32
+
+    def _exec_bclr(self, d: Decoded):
+        x = self.regfile.reg_file
+        x[d.rd] = x[d.rs1] & ~(1 << (x[d.rs2] & 0x1f))
+
+    def _exec_bext(self, d: Decoded):
+        x = self.regfile.reg_file
+        x[d.rd] = (x[d.rs1] >> (x[d.rs2] & 0x1f)) & 1
+
+    def _exec_binv(self, d: Decoded):
+        x = self.regfile.reg_file
+        x[d.rd] = x[d.rs1] ^ (1 << (x[d.rs2] & 0x1f))
+
+    def _exec_bset(self, d: Decoded):
+        x = self.regfile.reg_file
+        x[d.rd] = x[d.rs1] | (1 << (x[d.rs2] & 0x1f))
+
+    # BRANCH ---------------------------------------------------------------- #
+
+    def _exec_beq(self, d: Decoded):
+        x = self.regfile.reg_file
+        if x[d.rs1] == x[d.rs2]:
+            self.new_pc = (self.pc + d.imm) & MASK32
+
+    def _exec_bne(self, d: Decoded):
+        x = self.regfile.reg_file
+        if x[d.rs1] != x[d.rs2]:
+            self.new_pc = (self.pc + d.imm) & MASK32
+
+    def _exec_blt(self, d: Decoded):
+        x = self.regfile.reg_file
+        if (x[d.rs1] ^ SIGN32) < (x[d.rs2] ^ SIGN32):
+            self.new_pc = (self.pc + d.imm) & MASK32
+
+    def _exec_bge(self, d: Decoded):
+        x = self.regfile.reg_file
+        if (x[d.rs1] ^ SIGN32) >= (x[d.rs2] ^ SIGN32):
+            self.new_pc = (self.pc + d.imm) & MASK32
+
+    def _exec_bltu(self, d: Decoded):
+        x = self.regfile.reg_file
+        if x[d.rs1] < x[d.rs2]:
+            self.new_pc = (self.pc + d.imm) & MASK32
+
+    def _exec_bgeu(self, d: Decoded):
+        x = self.regfile.reg_file
+        if x[d.rs1] >= x[d.rs2]:
+            self.new_pc = (self.pc + d.imm) & MASK32
+
+    # ------------------------------------------------------------------------ #
+
+    def _exec_auipc(self, d: Decoded):
+        self.regfile.reg_file[d.rd] = (self.pc + d.imm) & MASK32
+
+    def _exec_store(self, d: Decoded):
+        x = self.regfile.reg_file
+        return self.mem_write((x[d.rs1] + d.imm) & MASK32, x[d.rs2], 1<<d.f3)
+
+    def _exec_load(self, d: Decoded):
+        x = self.regfile.reg_file
+        size_byte = 1<<(d.f3&0b11)
+        value = self.mem_read((x[d.rs1] + d.imm) & MASK32, size_byte)
+        if d.rd:
+            if not d.f3&0b100:
+                sign = 1<<(size_byte*8-1)
+                value = ((value ^ sign) - sign) & MASK32
+            x[d.rd] = value
+
+    # AMO ------------------------------------------------------------------- #
+
+    def _exec_lr(self, d: Decoded):
+        x = self.regfile.reg_file
+        addr = x[d.rs1]
+        if addr & 0b11:
+            raise Trap(ExceptionCode.LoadAddressMisaligned, addr)
+        value = self.sys_bus.load_reserved(self.mmu.paddr(addr, LOAD), 4,
+            self.hartid)
+        if d.rd:
+            x[d.rd] = value
+
+    def _exec_amo(self, d: Decoded):
+        op = AMO_W_OPS.get(d.f7>>2)
+        if op is None:
+            return self._exec_illegal(d)
+        x = self.regfile.reg_file
+        addr = x[d.rs1]
+        if addr & 0b11:
+            raise Trap(ExceptionCode.StoreAmoAddressMisaligned, addr)
+        old = self.sys_bus.amo(self.mmu.paddr(addr, STORE), op, x[d.rs2], 4)
+        if d.rd:
+            x[d.rd] = old
+
+    # F/D ------------------------------------------------------------------- #
+    # FMV.X.D, FMV.D.X and the 64 bit integer conversions are RV64 only
+
+    def _exec_load_fp(self, d: Decoded):
+        value = self.mem_read((self.regfile.reg_file[d.rs1] + d.imm) & MASK32,
+            1<<d.f3)
+        if d.f3 == FP_LS_F3.W.value:
+            value |= BOX
+        self.fregfile.reg_file[d.rd] = value
+        self.csr.regs[MSTATUS_ADDR] |= self.fp_dirty
+
+    def _exec_store_fp(self, d: Decoded):
+        return self.mem_write((self.regfile.reg_file[d.rs1] + d.imm) & MASK32,
+            self.fregfile.reg_file[d.rs2], 1<<d.f3)
+
+    def _exec_fmv_x(self, d: Decoded): # FMV.X.W
+        if d.rs2 or d.f7 & 1:
+            return self._exec_illegal(d)
+        if d.rd:
+            self.regfile.reg_file[d.rd] = self.fregfile.reg_file[d.rs1] & MASK32
+
+    def _exec_fmv_from_x(self, d: Decoded): # FMV.W.X
+        if d.rs2 or d.f7 & 1:
+            return self._exec_illegal(d)
+        self.fregfile.reg_file[d.rd] = BOX | self.regfile.reg_file[d.rs1]
+        self.csr.regs[MSTATUS_ADDR] |= self.fp_dirty
+
+    def _exec_fcvt_to_int(self, d: Decoded): # FCVT.{W,WU}.{S,D}
+        if d.rs2 > 0b01:
+            return self._exec_illegal(d)
+        f = self.fregfile.reg_file
+        rm = self._fp_rm(d)
+        signed = not d.rs2
+        if d.f7 & 1:
+            value, flags = fpu.to_int(F64, f[d.rs1], rm, signed, 32)
+        else:
+            value, flags = fpu.to_int(F32, unbox(f[d.rs1]), rm, signed, 32)
+        if flags:
+            regs = self.csr.regs
+            regs[FCSR_ADDR] |= flags
+            regs[MSTATUS_ADDR] |= self.fp_dirty
+        if d.rd:
+            self.regfile.reg_file[d.rd] = value & MASK32
+
+    def _exec_fcvt_from_int(self, d: Decoded): # FCVT.{S,D}.{W,WU}
+        if d.rs2 > 0b01:
+            return self._exec_illegal(d)
+        f = self.fregfile.reg_file
+        regs = self.csr.regs
+        rm = self._fp_rm(d)
+        value = self.regfile.reg_file[d.rs1]
+        if not d.rs2:
+            value = (value ^ SIGN32) - SIGN32
+        if d.f7 & 1:
+            f[d.rd], flags = fpu.from_int(F64, value, rm)
+        else:
+            value, flags = fpu.from_int(F32, value, rm)
+            f[d.rd] = BOX | value
+        regs[FCSR_ADDR] |= flags
+        regs[MSTATUS_ADDR] |= self.fp_dirty
+
+
+class RV32HartTraced(RV32Hart):
+    """RV32Hart whose step() logs every instruction, see step_traced()"""
+
+    __slots__ = ()
+
+    step = RV64Hart.step_traced
+
+RV32Hart.traced_class = RV32HartTraced
+
+
+# the .W AMOs by f5, the device masks the result to 32 bit
+AMO_W_OPS = {f5: op for (f5, f3), op in AMO_OPS.items() 
+    if f3 == AMO_F3.W.value}
+
+# ------------------------------ DISPATCH ------------------------------------ #
+
+def _rv64_only(key) -> bool:
+    """encodings of the RV64 tables that are reserved on RV32"""
+    if not isinstance(key, tuple): # OP_HANDLERS
+        return False
+    op, f3 = key[0], key[1]
+    if op in (Ops.OP_32.value, Ops.OP_IMM_32.value):
+        return True
+    if op == Ops.LOAD.value:
+        return f3 in (LD_F3.LD.value, LD_F3.LWU.value)
+    if op in (Ops.STORE.value, Ops.AMO.value):
+        return f3 == 0b011 # SD, the .D AMOs
+    # shamt[5]
+    return op == Ops.OP_IMM.value and len(key) > 2 and key[2] & 1
+
+def _rv32_table(table: dict) -> dict:
+    return {key: getattr(RV32Hart, handler.__name__)
+        for key, handler in table.items() if not _rv64_only(key)}
+
+RV32Hart.OP_HANDLERS = _rv32_table(RV64Hart.OP_HANDLERS)
+RV32Hart.OP_F3_HANDLERS = _rv32_table(RV64Hart.OP_F3_HANDLERS)
+RV32Hart.OP_F7_HANDLERS = _rv32_table(RV64Hart.OP_F7_HANDLERS)
+RV32Hart.OP_RM_HANDLERS = _rv32_table(RV64Hart.OP_RM_HANDLERS)
+RV32Hart.ZB_HANDLERS = _rv32_table(RV64Hart.ZB_HANDLERS)
+RV32Hart.ZB_RS2_HANDLERS = _rv32_table(RV64Hart.ZB_RS2_HANDLERS)
+# zext.h and rev8 have their own encodings on RV32
+RV32Hart.ZB_RS2_HANDLERS.update({
+    (Ops.OP.value, 0b100, ZB_F7.ADD_UW.value, 0) : RV32Hart._exec_zext_h,
+    (Ops.OP_IMM.value, 0b101, ZB_F7.BINV.value, ZBB_RS2.REV8.value) :
+        RV32Hart._exec_rev8,
+})
+RV32Hart.RD0_HANDLERS = {
+    RV32Hart._exec_jal  : RV32Hart._exec_j,
+    RV32Hart._exec_jalr : RV32Hart._exec_jr,
+}
@@ -0,0 +1,190 @@
+"""
+RVC: every 16 bit instruction is expanded to its 32 bit equivalent, the
+hart then decodes and executes the expansion like any other instruction.
+
+RVC_TABLE maps each of the 65536 halfwords to the expanded instruction, 0
+(an illegal encoding) for the reserved ones and for quadrant 3 which is
+not compressed. It is built once at import, RVC32_TABLE is the RV32C one.
+"""
+from typing import List
+
+from cpu_enums import Ops
+from utils import sign_extend
+
+# ------------------------------- ENCODERS ----------------------------------- #
+
+def _r(op, f3, f7, rd, rs1, rs2):
+    return (f7<<25)|(rs2<<20)|(rs1<<15)|(f3<<12)|(rd<<7)|op
+
+def _i(op, f3, rd, rs1, imm):
+    return ((imm&0xfff)<<20)|(rs1<<15)|(f3<<12)|(rd<<7)|op
+
+def _s(op, f3, rs1, rs2, imm):
+    return (((imm>>5)&0x7f)<<25)|(rs2<<20)|(rs1<<15)|(f3<<12)|((imm&0x1f)<<7)|op
+
+def _b(f3, rs1, rs2, imm):
+    return (((imm>>12)&1)<<31)|(((imm>>5)&0x3f)<<25)|(rs2<<20)|(rs1<<15)\
+        |(f3<<12)|(((imm>>1)&0xf)<<8)|(((imm>>11)&1)<<7)|Ops.BRANCH.value
+
+def _j(rd, imm):
+    return (((imm>>20)&1)<<31)|(((imm>>1)&0x3ff)<<21)|(((imm>>11)&1)<<20)\
+        |(((imm>>12)&0xff)<<12)|(rd<<7)|Ops.JAL.value
+
+def _bits(h, hi, lo):
+    return (h>>lo) & ((1<<(hi-lo+1))-1)
+
+OP, OP_32 = Ops.OP.value, Ops.OP_32.value
+OP_IMM, OP_IMM_32 = Ops.OP_IMM.value, Ops.OP_IMM_32.value
+LOAD, STORE = Ops.LOAD.value, Ops.STORE.value
+LOAD_FP, STORE_FP = Ops.LOAD_FP.value, Ops.STORE_FP.value
+JALR, LUI = Ops.JALR.value, Ops.LUI.value
+EBREAK = 0x0010_0073
+
+# ------------------------------- EXPANSION ---------------------------------- #
+
+def expand(h: int, xlen: int = 64) -> int:
+    """32 bit equivalent of the compressed instruction h, 0 if reserved"""
+    rv32 = xlen == 32
+    quadrant = h & 0b11
+    f3 = h>>13
+    rd = _bits(h, 11, 7)
+    rs2 = _bits(h, 6, 2)
+    # registers x8-x15 of the CIW/CL/CS/CA/CB formats
+    rd_ = _bits(h, 4, 2)+8
+    rs1_ = _bits(h, 9, 7)+8
+    # 6 bit immediate of CI, imm[5] is bit 12
+    imm6 = sign_extend(_bits(h, 12, 12)<<5 | _bits(h, 6, 2), 6)
+    # load/store offsets of the word and double word forms
+    off_w = _bits(h, 12, 10)<<3 | _bits(h, 6, 6)<<2 | _bits(h, 5, 5)<<6
+    off_d = _bits(h, 12, 10)<<3 | _bits(h, 6, 5)<<6
+
+    if quadrant == 0b00:
+        if f3 == 0b000: # C.ADDI4SPN
+            imm = _bits(h, 12, 11)<<4 | _bits(h, 10, 7)<<6 | \
+                _bits(h, 6, 6)<<2 | _bits(h, 5, 5)<<3
+            return _i(OP_IMM, 0b000, rd_, 2, imm) if imm else 0
+        if f3 == 0b001: # C.FLD
+            return _i(LOAD_FP, 0b011, rd_, rs1_, off_d)
+        if f3 == 0b010: # C.LW
+            return _i(LOAD, 0b010, rd_, rs1_, off_w)
+        if f3 == 0b011:
+            if rv32: # C.FLW
+                return _i(LOAD_FP, 0b010, rd_, rs1_, off_w)
+            # C.LD
+            return _i(LOAD, 0b011, rd_, rs1_, off_d)
+        if f3 == 0b101: # C.FSD
+            return _s(STORE_FP, 0b011, rs1_, rd_, off_d)
+        if f3 == 0b110: # C.SW
+            return _s(STORE, 0b010, rs1_, rd_, off_w)
+        if f3 == 0b111:
+            if rv32: # C.FSW
+                return _s(STORE_FP, 0b010, rs1_, rd_, off_w)
+            # C.SD
+            return _s(STORE, 0b011, rs1_, rd_, off_d)
+        return 0
+
+    if quadrant == 0b01:
+        if f3 == 0b000: # C.ADDI, C.NOP
+            return _i(OP_IMM, 0b000, rd, rd, imm6)
+        if f3 == 0b001:
+            if rv32: # C.JAL
+                return _j(1, _cj_imm(h))
+            # C.ADDIW
+            return _i(OP_IMM_32, 0b000, rd, rd, imm6) if rd else 0
+        if f3 == 0b010: # C.LI
+            return _i(OP_IMM, 0b000, rd, 0, imm6)
+        if f3 == 0b011:
+            if rd == 2: # C.ADDI16SP
+                imm = sign_extend(_bits(h, 12, 12)<<9 | _bits(h, 6, 6)<<4 | \
+                    _bits(h, 5, 5)<<6 | _bits(h, 4, 3)<<7 | _bits(h, 2, 2)<<5, 10)
+                return _i(OP_IMM, 0b000, 2, 2, imm) if imm else 0
+            # C.LUI
+            return ((imm6 & 0xfffff)<<12)|(rd<<7)|LUI if imm6 else 0
+        if f3 == 0b100:
+            f2 = _bits(h, 11, 10)
+            shamt = _bits(h, 12, 12)<<5 | rs2
+            if f2 < 0b10 and rv32 and shamt > 31:
+                return 0
+            if f2 == 0b00: # C.SRLI
+                return _i(OP_IMM, 0b101, rs1_, rs1_, shamt)
+            if f2 == 0b01: # C.SRAI
+                return _i(OP_IMM, 0b101, rs1_, rs1_, 0x400|shamt)
+            if f2 == 0b10: # C.ANDI
+                return _i(OP_IMM, 0b111, rs1_, rs1_, imm6)
+            f = _bits(h, 6, 5)
+            if not h & (1<<12):
+                # C.SUB, C.XOR, C.OR, C.AND
+                f3_, f7 = ((0b000, 0x20), (0b100, 0), (0b110, 0), (0b111, 0))[f]
+                return _r(OP, f3_, f7, rs1_, rs1_, rd_)
+            if rv32:
+                return 0
+            if f == 0b00: # C.SUBW
+                return _r(OP_32, 0b000, 0x20, rs1_, rs1_, rd_)
+            if f == 0b01: # C.ADDW
+                return _r(OP_32, 0b000, 0, rs1_, rs1_, rd_)
+            return 0
+        if f3 == 0b101: # C.J
+            return _j(0, _cj_imm(h))
+        # C.BEQZ, C.BNEZ
+        imm = sign_extend(_bits(h, 12, 12)<<8 | _bits(h, 11, 10)<<3 | \
+            _bits(h, 6, 5)<<6 | _bits(h, 4, 3)<<1 | _bits(h, 2, 2)<<5, 9)
+        return _b(f3 & 1, rs1_, 0, imm)
+
+    if quadrant == 0b10:
+        # stack pointer relative offsets
+        lsp_d = _bits(h, 12, 12)<<5 | _bits(h, 6, 5)<<3 | _bits(h, 4, 2)<<6
+        ssp_d = _bits(h, 12, 10)<<3 | _bits(h, 9, 7)<<6
+        lsp_w = _bits(h, 12, 12)<<5 | _bits(h, 6, 4)<<2 | _bits(h, 3, 2)<<6
+        ssp_w = _bits(h, 12, 9)<<2 | _bits(h, 8, 7)<<6
+        if f3 == 0b000: # C.SLLI
+            shamt = _bits(h, 12, 12)<<5 | rs2
+            if rv32 and shamt > 31:
+                return 0
+            return _i(OP_IMM, 0b001, rd, rd, shamt)
+        if f3 == 0b001: # C.FLDSP
+            return _i(LOAD_FP, 0b011, rd, 2, lsp_d)
+        if f3 == 0b010: # C.LWSP
+            return _i(LOAD, 0b010, rd, 2, lsp_w) if rd else 0
+        if f3 == 0b011:
+            if rv32: # C.FLWSP
+                return _i(LOAD_FP, 0b010, rd, 2, lsp_w)
+            # C.LDSP
+            return _i(LOAD, 0b011, rd, 2, lsp_d) if rd else 0
+        if f3 == 0b100:
+            if not h & (1<<12):
+                if rs2 == 0: # C.JR
+                    return _i(JALR, 0b000, 0, rd, 0) if rd else 0
+                return _r(OP, 0b000, 0, rd, 0, rs2) # C.MV
+            if rs2 == 0:
+                if rd == 0:
+                    return EBREAK # C.EBREAK
+                return _i(JALR, 0b000, 1, rd, 0) # C.JALR
+            return _r(OP, 0b000, 0, rd, rd, rs2) # C.ADD
+        if f3 == 0b101: # C.FSDSP
+            return _s(STORE_FP, 0b011, 2, rs2, ssp_d)
+        if f3 == 0b110: # C.SWSP
+            return _s(STORE, 0b010, 2, rs2, ssp_w)
+        if rv32: # C.FSWSP
+            return _s(STORE_FP, 0b010, 2, rs2, ssp_w)
+        # C.SDSP
+        return _s(STORE, 0b011, 2, rs2, ssp_d)
+
+    return 0
+
+
+def _cj_imm(h: int) -> int:
+    """offset of C.J and C.JAL"""
+    return sign_extend(_bits(h, 12, 12)<<11 | _bits(h, 11, 11)<<4 | \
+        _bits(h, 10, 9)<<8 | _bits(h, 8, 8)<<10 | _bits(h, 7, 7)<<6 | \
+        _bits(h, 6, 6)<<7 | _bits(h, 5, 3)<<1 | _bits(h, 2, 2)<<5, 12)
+
+
+def _build_table(xlen: int) -> List[int]:
+    table = [0]*0x10000
+    for h in range(0x10000):
+        if h & 0b11 != 0b11:
+            table[h] = expand(h, xlen)
+    return table
+
+RVC_TABLE : List[int] = _build_table(64)
+RVC32_TABLE : List[int] = _build_table(32)
@@ -1,70 +1,218 @@
 import logging
+from bisect import bisect_right
 from devices import *
 from typing import List, Dict, Tuple
 
 log = logging.getLogger(__name__)
 
+# devices up to this many pages get an entry per page in the page table,
+# bigger ones are only found through the interval index
+MAX_DENSE_PAGES = 1<<16
+
+# LR reserves the aligned 8 bytes around its address, any store or AMO
+# touching them invalidates the reservation
+RESERVATION_SHIFT = 3
+
+# (start, end, device, base), end is inclusive and the device sees the
+# address addr-base. base is the device start address, the two differ for 
+# the part of a device above an overlay
+Region = Tuple[int, int, BaseDevice, int]
+
+
+class BusError(Exception):
+    """
+    access to a physical address where no device is registered, the hart
+    and the MMU turn it into an access fault
+    """
+
+    def __init__(self, addr: int, store: bool = False):
+        super().__init__(f"no device registered in 0x{addr:X}")
+        self.addr = addr
+        self.store = store
 
 
 class SystemInterface():
     
-    def __init__(self):
+    def __init__(self, trace: bool = None):
         
         self.dev_map : Dict[int, BaseDevice] = {}
         self.dev_list : List[BaseDevice] = []
         self.mem_map : List[List[int, int]] = []
-    
-    def register_device(self, dev: BaseDevice, start_address):
         
-        # TODO: optimize the whole function @DavideRuzza 
+        # address decode: last region hit, then page table, then a bisect 
+        # over the sorted region starts
+        self.regions : List[Region] = []
+        self.starts : List[int] = []
+        self.page_table : Dict[int, Region] = {}
+        self.last_hit : Region = (1, 0, None, 0)
+        
+        # LR/SC reservation set of each hart, hartid -> reserved granule.
+        # Usually empty, which is all the store path has to test
+        self.reservations : Dict[int, int] = {}
+        
+        # access logging is decided once, by default from the logger level
+        if trace is None:
+            trace = log.isEnabledFor(logging.DEBUG)
+        self.set_trace(trace)
+    
+    def set_trace(self, trace: bool):
+        """switch read/write between the fast and the logging version"""
+        self.trace : bool = trace
+        if trace:
+            self.read = self.read_traced
+            self.write = self.write_traced
+        else:
+            self.__dict__.pop("read", None)
+            self.__dict__.pop("write", None)
+    
+    def register_device(self, dev: BaseDevice, start_address, 
+            overlay: bool = False):
+        """
+        map dev at start_address. With overlay the device is placed on top of
+        part of an already registered one (e.g. HTIF inside the RAM), which
+        keeps the rest of its range
+        """
         
         assert dev not in self.dev_list, f"'{dev.name}' already registered"
         
-        index = 0
-        for i, addr in enumerate(self.mem_map):
-            
-            if start_address<addr[0]:
-                index = i
-            elif start_address>addr[1]:
-                index = i+1
-            
-            if (addr[0]<=start_address<=addr[1]) or \
-                (addr[0]<=start_address+dev.size<=addr[1]):
-                raise Exception(f"address overlap with {self.dev_list[i].name}")
+        end_address = start_address+dev.size-1
+        index = bisect_right(self.starts, start_address)
+        
+        if overlay:
+            under = self.regions[index-1] if index>0 else None
+            if under is None or under[1]<end_address:
+                raise Exception(f"{dev.name} does not fit in a single device")
+            u_start, u_end, u_dev, u_base = under
+            split = [(u_start, start_address-1, u_dev, u_base),
+                (start_address, end_address, dev, start_address),
+                (end_address+1, u_end, u_dev, u_base)]
+            new_regions = [r for r in split if r[0]<=r[1]]
+            self.regions[index-1:index] = new_regions
+        else:
+            if index>0 and self.regions[index-1][1]>=start_address:
+                raise Exception(
+                    f"address overlap with {self.regions[index-1][2].name}")
+            if index<len(self.regions) and self.regions[index][0]<=end_address:
+                raise Exception(
+                    f"address overlap with {self.regions[index][2].name}")
+            new_regions = [(start_address, end_address, dev, start_address)]
+            self.regions.insert(index, new_regions[0])
+        self.starts = [r[0] for r in self.regions]
         
+        index = bisect_right([s for s, e in self.mem_map], start_address)
         self.dev_list.insert(index, dev)
-        self.mem_map.insert(index, [start_address, start_address+dev.size-1])
-        self.dev_map = {}
+        self.mem_map.insert(index, [start_address, end_address])
+        self.dev_map[start_address] = dev
         
-        for addr, dev in zip(self.mem_map, self.dev_list):
-            self.dev_map[addr[0]] = dev
+        # only the pages of the new regions change (an overlay splits the
+        # region under it, whose pieces keep its device and base)
+        self.last_hit = (1, 0, None, 0)
+        for region in new_regions:
+            self._update_pages(region)
+    
+    def _update_pages(self, region: Region):
+        """page table entries of the pages overlapping region"""
+        first_page = region[0]>>PAGE_SHIFT
+        last_page = region[1]>>PAGE_SHIFT
+        if last_page-first_page >= MAX_DENSE_PAGES:
+            return
+        for page in range(first_page, last_page+1):
+            page_start = page<<PAGE_SHIFT
+            page_end = page_start+PAGE_SIZE-1
+            i = bisect_right(self.starts, page_end)-1
+            hits = []
+            while i>=0 and self.regions[i][1]>=page_start:
+                hits.append(self.regions[i])
+                i -= 1
+            # a page shared by two regions is left to the interval index
+            self.page_table[page] = hits[0] if len(hits) == 1 else None
+    
+    def decode(self, addr: int, store: bool = False, size: int = 1) -> Region:
+        region = self.page_table.get(addr>>PAGE_SHIFT)
+        if region is None or not region[0]<=addr<=region[1]:
+            i = bisect_right(self.starts, addr)-1
+            if i<0 or addr>self.regions[i][1]:
+                raise BusError(addr, store)
+            region = self.regions[i]
+        # an access running past the end of the region does not reach the
+        # device
+        if addr+size-1 > region[1]:
+            raise BusError(addr, store)
+        self.last_hit = region
+        return region
         
     def read(self, addr: int, size: int = 4):
         
-        for mem in self.mem_map:
-            st, end = mem
-            
-            if st<=addr<=end:
-                rel_addr = addr-st
-                dev = self.dev_map[st]
-                result = dev.read(addr=rel_addr, size=size)
-                log.debug(f"read {dev.name}: 0x{addr:X} -> 0x{result:0{size}x}")
-                return result
-            
-        raise Exception(f"no device registered in 0x{addr:X}")
+        st, end, dev, base = self.last_hit
+        if not st<=addr<=end-size+1:
+            st, end, dev, base = self.decode(addr, False, size)
+        
+        return dev.read(addr-base, size)
     
+    # the device write result is passed back to the store, a device returning
+    # False (e.g. HTIF on exit) stops the hart
     def write(self, addr: int, value: int, size: int = 4):
-        for mem in self.mem_map:
-            st, end = mem
         
-            if st<=addr<=end:
-                rel_addr = addr-st
-                dev = self.dev_map[st]
-                dev.write(addr=rel_addr, value=value, size=size)
-                log.debug(f"write {dev.name}: 0x{addr:X} <- 0x{value:0{size}x}")
-                return True
+        if self.reservations:
+            self.invalidate(addr, size)
+        st, end, dev, base = self.last_hit
+        if not st<=addr<=end-size+1:
+            st, end, dev, base = self.decode(addr, True, size)
+        
+        return dev.write(addr-base, value, size)
+    
+    # ----------------------------- ATOMICS ---------------------------------- #
+    # on physical, naturally aligned addresses. Each one is a single bus
+    # operation: one address decode and no other access in between
+    
+    def amo(self, addr: int, op, value: int, size: int = 4) -> int:
+        """memory = op(memory, value), returns the old memory value"""
+        
+        if self.reservations:
+            self.invalidate(addr, size)
+        st, end, dev, base = self.last_hit
+        if not st<=addr<=end-size+1:
+            st, end, dev, base = self.decode(addr, True, size)
         
-        raise Exception(f"no device registered in 0x{addr:X}")
+        old = dev.amo(addr-base, op, value, size)
+        if self.trace:
+            log.debug(f"amo {dev.name}: 0x{addr:X} 0x{old:0{size*2}x} -> "\
+                f"0x{op(old, value)&((1<<(8*size))-1):0{size*2}x}")
+        return old
+    
+    def load_reserved(self, addr: int, size: int, hartid: int) -> int:
+        value = self.read(addr, size)
+        self.reservations[hartid] = addr>>RESERVATION_SHIFT
+        return value
+    
+    def store_conditional(self, addr: int, value: int, size: int, 
+            hartid: int) -> bool:
+        """the store is done only if the hart still holds the reservation"""
+        if self.reservations.pop(hartid, None) != addr>>RESERVATION_SHIFT:
+            return False
+        self.write(addr, value, size)
+        return True
+    
+    def invalidate(self, addr: int, size: int):
+        """drop the reservations on the granules of a store"""
+        first = addr>>RESERVATION_SHIFT
+        last = (addr+size-1)>>RESERVATION_SHIFT
+        for hartid, granule in list(self.reservations.items()):
+            if first<=granule<=last:
+                del self.reservations[hartid]
+    
+    def read_traced(self, addr: int, size: int = 4):
+        st, end, dev, base = self.decode(addr, False, size)
+        result = dev.read(addr-base, size)
+        log.debug(f"read {dev.name}: 0x{addr:X} -> 0x{result:0{size*2}x}")
+        return result
+    
+    def write_traced(self, addr: int, value: int, size: int = 4):
+        if self.reservations:
+            self.invalidate(addr, size)
+        st, end, dev, base = self.decode(addr, True, size)
+        log.debug(f"write {dev.name}: 0x{addr:X} <- 0x{value:0{size*2}x}")
+        return dev.write(addr-base, value, size)
     
     def __repr__(self):
         
@@ -0,0 +1,109 @@
+"""
+Checkpoint round trip: registers, CSRs, sparse RAM pages and the CLINT
+time, restored into a machine that ran on after the save:
+
+    python -m unittest test_checkpoint
+"""
+import json
+import os
+import tempfile
+import unittest
+import zlib
+
+from benchmark import addi, jal_self
+from checkpoint import save_checkpoint, load_checkpoint, MAGIC, HEADER_LEN
+from clint import ClintDevice, CLINT_BASE, MTIMECMP
+from cpu_enums import Ext
+from devices import SparseMemoryDevice, PAGE_SIZE
+from main import RV64Hart
+from system_interface import SystemInterface
+
+RAM_BASE = 0x8000_0000
+RAM_SIZE = 1<<20
+
+
+def make_machine():
+    ram = SparseMemoryDevice(RAM_SIZE, "RAM")
+    # x5 counts up, then the hart spins
+    program = [addi(5, 5, 1)]*2000 + [jal_self()]
+    for i, ins in enumerate(program):
+        ram.write(4*i, ins, 4)
+    sys_bus = SystemInterface()
+    sys_bus.register_device(ram, RAM_BASE)
+    clint = ClintDevice()
+    sys_bus.register_device(clint, CLINT_BASE)
+    hart = RV64Hart(0, sys_bus, [Ext.S, Ext.U], entry_point=RAM_BASE)
+    clint.attach(hart)
+    return sys_bus, ram, clint, hart
+
+
+def read_header(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    pos = len(MAGIC)
+    (n,) = HEADER_LEN.unpack_from(data, pos)
+    pos += HEADER_LEN.size
+    return json.loads(zlib.decompress(data[pos:pos+n]))
+
+
+class CheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".ckpt")
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_round_trip(self):
+        sys_bus, ram, clint, hart = make_machine()
+        sys_bus.write(CLINT_BASE+MTIMECMP, 1<<40, 8)
+        hart.run_steps(1500)
+        hart.csr.mscratch.all = 0x1234_5678
+        # two identical pages and one different, away from the code
+        for page in (0x80, 0x81):
+            ram.write(page*PAGE_SIZE, 0xdead_beef, 4)
+        ram.write(0x90*PAGE_SIZE, 0xcafe, 4)
+        save_checkpoint(self.path, sys_bus, [hart])
+        saved = (hart.pc, hart.regfile.reg_file[5], hart.csr.regs[0xb02],
+            clint.events.now)
+
+        # run on and dirty everything, a new page included
+        hart.run_steps(400)
+        hart.csr.mscratch.all = 0
+        ram.write(0x80*PAGE_SIZE, 0, 4)
+        ram.write(0xa0*PAGE_SIZE, 0x55, 4)
+        sys_bus.write(CLINT_BASE+MTIMECMP, 5, 8)
+        self.assertNotEqual((hart.pc, hart.regfile.reg_file[5]), saved[:2])
+
+        load_checkpoint(self.path, sys_bus, [hart])
+        self.assertEqual((hart.pc, hart.regfile.reg_file[5],
+            hart.csr.regs[0xb02], clint.events.now), saved)
+        self.assertEqual(saved[3], 1500)
+        self.assertEqual(hart.csr.mscratch.all, 0x1234_5678)
+        self.assertEqual(ram.read(0x80*PAGE_SIZE, 4), 0xdead_beef)
+        self.assertEqual(ram.read(0x90*PAGE_SIZE, 4), 0xcafe)
+        self.assertEqual(ram.read(0xa0*PAGE_SIZE, 4), 0)
+        self.assertEqual(sys_bus.read(CLINT_BASE+MTIMECMP, 8), 1<<40)
+        self.assertEqual(hart.csr.mip.MTIP, 0)
+
+        # the restored machine runs on like the original one
+        hart.run_steps(600)
+        self.assertEqual(hart.regfile.reg_file[5], 2000)
+
+    def test_page_dedup(self):
+        sys_bus, ram, clint, hart = make_machine()
+        for page in (0x80, 0x81, 0x82):
+            ram.write(page*PAGE_SIZE, 0xdead_beef, 4)
+        save_checkpoint(self.path, sys_bus, [hart])
+        header = read_header(self.path)
+        pages = [p for dev in header["devices"] for p in dev["pages"]]
+        ram_pages = {n: idx for dev in header["devices"] if dev["name"] == "RAM"
+            for n, idx in dev["pages"]}
+        # the three equal pages share a blob
+        self.assertEqual(len({ram_pages[n] for n in (0x80, 0x81, 0x82)}), 1)
+        self.assertEqual(len(header["blobs"]), len(pages)-2)
+
+
+if __name__ == "__main__":
+    unittest.main()
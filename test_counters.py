@@ -0,0 +1,73 @@
+"""
+Counter CSRs read between two quantum ticks, on both harts and both run
+loops:
+
+    python -m unittest test_counters
+"""
+import unittest
+
+from benchmark import addi, csrrs, csrrw
+from clint import ClintDevice, CLINT_BASE
+from cpu_enums import Ext
+from devices import MemoryDevice
+from main import RV64Hart
+from rv32 import RV32Hart
+from system_interface import SystemInterface
+
+RAM_BASE = 0x8000_0000
+
+CYCLE, INSTRET = 0xc00, 0xc02
+MINSTRET, MINSTRETH = 0xb02, 0xb82
+
+
+def make_hart(cls, program):
+    ram = MemoryDevice(0x1000, "RAM")
+    for i, ins in enumerate(program):
+        ram.write(4*i, ins, 4)
+    sys_bus = SystemInterface()
+    sys_bus.register_device(ram, RAM_BASE)
+    clint = ClintDevice()
+    sys_bus.register_device(clint, CLINT_BASE)
+    hart = cls(0, sys_bus, [Ext.S, Ext.U], entry_point=RAM_BASE)
+    clint.attach(hart)
+    return hart
+
+
+class CounterTest(unittest.TestCase):
+
+    def run_program(self, program, check):
+        for cls in (RV64Hart, RV32Hart):
+            for mode in ("steps", "blocks"):
+                with self.subTest(hart=cls.__name__, mode=mode):
+                    hart = make_hart(cls, program)
+                    getattr(hart, "run_"+mode)(len(program))
+                    check(hart.regfile.reg_file)
+
+    def test_instret_gap(self):
+        # well inside the first quantum
+        program = [addi(5, 5, 1)]*10 + [csrrs(10, INSTRET, 0)] + \
+            [addi(5, 5, 1)]*2 + [csrrs(11, INSTRET, 0), csrrs(12, CYCLE, 0)]
+        def check(x):
+            self.assertEqual(x[10], 10)
+            self.assertEqual(x[11]-x[10], 3)
+            self.assertEqual(x[12], 14)
+        self.run_program(program, check)
+
+    def test_minstret_write(self):
+        # the written value is read back, the writing instruction not counted
+        program = [addi(5, 0, 100), addi(6, 6, 1), csrrw(0, MINSTRET, 5),
+            addi(6, 6, 1), csrrs(10, MINSTRET, 0)]
+        self.run_program(program, lambda x: self.assertEqual(x[10], 101))
+
+    def test_minstreth(self):
+        # RV32: the 64 bit counter carries into minstreth
+        program = [addi(5, 0, -1), csrrw(0, MINSTRET, 5), addi(6, 6, 1),
+            csrrs(10, MINSTRET, 0), csrrs(11, MINSTRETH, 0)]
+        hart = make_hart(RV32Hart, program)
+        hart.run_steps(len(program))
+        x = hart.regfile.reg_file
+        self.assertEqual((x[10], x[11]), (0, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
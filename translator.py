@@ -0,0 +1,383 @@
+import logging
+from cpu_enums import *
+from decoder import Decoded, MASK64, MASK32, SIGN64, SIGN32
+from mmu import Trap
+from system_interface import BusError
+from typing import Dict, List, Set
+
+log = logging.getLogger(__name__)
+
+MAX_BLOCK_LEN = 64
+# times a pc is reached through the interpreter before a block is compiled
+# from it: compile() costs a few hundred interpreted instructions, code run
+# once (boot, test setup) is cheaper to interpret
+HOT_THRESHOLD = 16
+
+
+class Halt(Exception):
+    """raised by a translated block when the guest stops the simulation"""
+
+
+class Block:
+    """Translated basic block, `fn(hart, X)` runs it and returns the next pc"""
+
+    __slots__ = ("start", "n_ins", "fn", "links", "src", "retired")
+
+    def __init__(self, start: int, n_ins: int, fn, src: str, 
+            retired: Dict[int, int]):
+        self.start = start
+        self.n_ins = n_ins
+        self.fn = fn
+        self.src = src
+        # pc -> instructions of the block before it, retired when the block
+        # stops at that pc on an exception
+        self.retired = retired
+        # successor blocks by pc, filled by the run loop to chain blocks
+        self.links : Dict[int, 'Block'] = {}
+
+    def __repr__(self):
+        return f"Block(0x{self.start:08X}, n_ins={self.n_ins})"
+
+
+class BlockTranslator:
+    """
+    Translate straight-line guest code into one python function per basic
+    block. A block ends at BRANCH/JAL/JALR (emitted inline) or right before
+    an instruction that is left to the interpreter (SYSTEM, FENCE.I,
+    anything not handled here). Registers used in the block live in local
+    variables and are written back to the register file on exit. Only hot
+    code is translated, a pc is left to the interpreter the first 
+    `threshold` times it is looked up.
+    """
+
+    def __init__(self, hart, max_len: int = MAX_BLOCK_LEN, 
+            threshold: int = HOT_THRESHOLD):
+        self.hart = hart
+        self.max_len = max_len
+        self.threshold = threshold
+        self.cache : Dict[int, Block] = {}
+        # pcs whose first instruction must go through the interpreter
+        self.no_block : Set[int] = set()
+        # lookups of the pcs not translated yet
+        self.heat : Dict[int, int] = {}
+
+    def flush(self):
+        self.cache.clear()
+        self.no_block.clear()
+        self.heat.clear()
+
+    def lookup(self, pc: int) -> Block:
+        # blocks access the bus directly, with address translation on every
+        # instruction goes through step()
+        if self.hart.mmu.active:
+            return None
+        blk = self.cache.get(pc)
+        if blk is None and pc not in self.no_block:
+            heat = self.heat.get(pc, 0)+1
+            if heat < self.threshold:
+                self.heat[pc] = heat
+                return None
+            self.heat.pop(pc, None)
+            blk = self.translate(pc)
+            if blk is None:
+                self.no_block.add(pc)
+            else:
+                self.cache[pc] = blk
+        return blk
+
+    # ------------------------------------------------------------------------ #
+
+    def translate(self, start: int) -> Block:
+        hart = self.hart
+        # the emitted code is RV64 only, an RV32 hart runs through step()
+        if hart.xlen != 64:
+            return None
+        body : List[str] = []
+        used : Set[int] = set()
+        written : Set[int] = set()
+        pc = start
+        n_ins = 0
+        end = None
+        retired : Dict[int, int] = {}
+
+        while n_ins < self.max_len:
+            d = hart.decode_cache.get(pc)
+            if d is None:
+                try:
+                    d = hart.decode_at(pc)
+                except (Trap, BusError):
+                    # step() fetches it again and takes the trap
+                    break
+
+            emitted = self.emit(d, pc, used, written)
+            if emitted is None:
+                break
+            lines, end = emitted
+            retired[pc] = n_ins
+            body.append(f"# 0x{pc:08X}: {d}")
+            body.extend(lines)
+            n_ins += 1
+            pc += d.ilen
+            if end is not None:
+                break
+
+        if n_ins == 0:
+            return None
+
+        if end is None:
+            end = [f"return 0x{pc:X}"]
+
+        name = f"block_{start:08x}"
+        wb = "; ".join(f"X[{r}] = x{r}" for r in sorted(written)) or "pass"
+        src = [f"def {name}(hart, X):"]
+        for r in sorted(used):
+            src.append(f"    x{r} = X[{r}]")
+        src.append(f"    _pc = 0x{start:X}")
+        src.append("    try:")
+        src.extend(f"        {l}" for l in body)
+        src.append("    except BaseException:")
+        src.append(f"        {wb}")
+        src.append("        hart.pc = _pc")
+        src.append("        raise")
+        src.append(f"    {wb}")
+        src.extend(f"    {l}" for l in end)
+        src = "\n".join(src)
+
+        namespace = {
+            "read" : hart.sys_bus.read,
+            "write" : hart.sys_bus.write,
+            "Halt" : Halt,
+        }
+        exec(compile(src, f"<{name}>", "exec"), namespace)
+
+        return Block(start, n_ins, namespace[name], src, retired)
+
+    def emit(self, d: Decoded, pc: int, used: Set[int], written: Set[int]):
+        """
+        return (lines, end) for the instruction, end is not None for a block
+        terminator and holds the lines computing the next pc. None is
+        returned if the instruction is left to the interpreter
+        """
+
+        def r(idx):
+            if idx == 0:
+                return "0"
+            used.add(idx)
+            return f"x{idx}"
+
+        def w(idx):
+            if idx == 0:
+                return "_"
+            used.add(idx)
+            written.add(idx)
+            return f"x{idx}"
+
+        op, f3, f7 = d.op, d.f3, d.f7
+        imm = d.imm
+        simm = imm - (1<<64) if imm & SIGN64 else imm
+
+        if op == Ops.LUI.value:
+            return [f"{w(d.rd)} = 0x{imm:X}"], None
+
+        elif op == Ops.AUIPC.value:
+            return [f"{w(d.rd)} = 0x{(pc + imm) & MASK64:X}"], None
+
+        elif op == Ops.OP.value or op == Ops.OP_32.value:
+            if f7 == MULDIV_F7:
+                expr = self.mul_expr(f3, r(d.rs1), r(d.rs2),
+                    op == Ops.OP_32.value)
+                if expr is None:
+                    return None
+                return [f"{w(d.rd)} = {expr}"], None
+            if f7 and self.hart.is_ext_impl(Ext.B):
+                expr = self.zb_expr(f3, f7, r(d.rs1), r(d.rs2),
+                    op == Ops.OP_32.value)
+                if expr is not None:
+                    return [f"{w(d.rd)} = {expr}"], None
+            if f7 not in (0, 0b0100000):
+                return None
+            if f7 and f3 not in (OP_F3.ADD_SUB.value, OP_F3.SRX.value):
+                return None
+            expr = self.alu_expr(f3, f7, r(d.rs1), r(d.rs2),
+                op == Ops.OP_32.value)
+            if expr is None:
+                return None
+            return [f"{w(d.rd)} = {expr}"], None
+
+        elif op == Ops.OP_IMM.value or op == Ops.OP_IMM_32.value:
+            op32 = op == Ops.OP_IMM_32.value
+            sra = 0
+            if f3 == OP_F3.SLL.value or f3 == OP_F3.SRX.value:
+                # any other imm[11:5] is not a shift (Zbb, Zbs...)
+                valid = (0, 0b0100000) if f3 == OP_F3.SRX.value else (0,)
+                if (f7 if op32 else f7 & ~1) not in valid:
+                    return None
+                shamt = imm & (0x1f if op32 else 0x3f)
+                sra = f7 & 0b0100000
+                op2 = str(shamt)
+            else:
+                op2 = f"0x{imm:X}" if not op32 else str(simm)
+            expr = self.alu_expr(f3, sra, r(d.rs1), op2, op32)
+            if expr is None:
+                return None
+            return [f"{w(d.rd)} = {expr}"], None
+
+        elif op == Ops.LOAD.value:
+            if f3 == 0b111:
+                return None
+            size = 1<<(f3&0b11)
+            value = f"read(({r(d.rs1)} + {simm}) & 0x{MASK64:X}, {size})"
+            if not f3&0b100 and size < 8:
+                sign = 1<<(size*8-1)
+                value = f"(({value} ^ 0x{sign:X}) - 0x{sign:X}) & 0x{MASK64:X}"
+            return [f"_pc = 0x{pc:X}", f"{w(d.rd)} = {value}"], None
+
+        elif op == Ops.STORE.value:
+            if f3 > 0b011:
+                return None
+            return [
+                f"_pc = 0x{pc:X}",
+                f"if write(({r(d.rs1)} + {simm}) & 0x{MASK64:X}, "
+                    f"{r(d.rs2)}, {1<<f3}) is False:",
+                "    raise Halt",
+            ], None
+
+        elif op == Ops.MISC_MEM.value:
+            if f3 != 0b000: # FENCE.I goes through the interpreter
+                return None
+            return ["pass"], None
+
+        elif op == Ops.BRANCH.value:
+            cond = self.branch_expr(f3, r(d.rs1), r(d.rs2))
+            if cond is None:
+                return None
+            taken = (pc + imm) & MASK64
+            return [f"_t = {cond}"], \
+                [f"return 0x{taken:X} if _t else 0x{pc+d.ilen:X}"]
+
+        elif op == Ops.JAL.value:
+            target = (pc + imm) & MASK64
+            return [f"{w(d.rd)} = 0x{pc+d.ilen:X}"], [f"return 0x{target:X}"]
+
+        elif op == Ops.JALR.value:
+            return [
+                f"_t = ({r(d.rs1)} + {simm}) & 0x{MASK64-1:X}",
+                f"{w(d.rd)} = 0x{pc+d.ilen:X}",
+            ], ["return _t"]
+
+        return None
+
+    @staticmethod
+    def alu_expr(f3: int, f7: int, a: str, b: str, op32: bool):
+        if op32:
+            mask, sh = MASK32, 0x1f
+        else:
+            mask, sh = MASK64, 0x3f
+
+        if f3 == OP_F3.ADD_SUB.value:
+            expr = f"({a} - {b})" if f7 else f"({a} + {b})"
+        elif f3 == OP_F3.SLL.value:
+            expr = f"({a} << ({b} & {sh}))"
+        elif f3 == OP_F3.SRX.value:
+            if f7:
+                sign = SIGN32 if op32 else SIGN64
+                expr = f"(((({a} & 0x{mask:X}) ^ 0x{sign:X}) - 0x{sign:X})"\
+                    f" >> ({b} & {sh}))"
+            else:
+                expr = f"(({a} & 0x{mask:X}) >> ({b} & {sh}))"
+        elif op32:
+            return None
+        elif f3 == OP_F3.SLT.value:
+            return f"(1 if (({a} ^ 0x{SIGN64:X}) - 0x{SIGN64:X}) < "\
+                f"(({b} ^ 0x{SIGN64:X}) - 0x{SIGN64:X}) else 0)"
+        elif f3 == OP_F3.SLTU.value:
+            return f"(1 if {a} < ({b} & 0x{MASK64:X}) else 0)"
+        elif f3 == OP_F3.XOR.value:
+            return f"(({a} ^ {b}) & 0x{MASK64:X})"
+        elif f3 == OP_F3.OR.value:
+            return f"(({a} | {b}) & 0x{MASK64:X})"
+        elif f3 == OP_F3.AND.value:
+            return f"({a} & {b})"
+        else:
+            return None
+
+        if op32:
+            return f"(((({expr} & 0x{MASK32:X}) ^ 0x{SIGN32:X}) - 0x{SIGN32:X})"\
+                f" & 0x{MASK64:X})"
+        return f"({expr} & 0x{MASK64:X})"
+
+    @staticmethod
+    def mul_expr(f3: int, a: str, b: str, op32: bool):
+        """multiplications, the divisions are left to the interpreter"""
+        def s(x):
+            return f"(({x} ^ 0x{SIGN64:X}) - 0x{SIGN64:X})"
+
+        if op32:
+            if f3 != MULDIV_F3.MUL.value:
+                return None
+            return f"((((({a} * {b}) & 0x{MASK32:X}) ^ 0x{SIGN32:X}) - "\
+                f"0x{SIGN32:X}) & 0x{MASK64:X})"
+        if f3 == MULDIV_F3.MUL.value:
+            return f"(({a} * {b}) & 0x{MASK64:X})"
+        elif f3 == MULDIV_F3.MULH.value:
+            return f"((({s(a)} * {s(b)}) >> 64) & 0x{MASK64:X})"
+        elif f3 == MULDIV_F3.MULHSU.value:
+            return f"((({s(a)} * {b}) >> 64) & 0x{MASK64:X})"
+        elif f3 == MULDIV_F3.MULHU.value:
+            return f"(({a} * {b}) >> 64)"
+        return None
+
+    @staticmethod
+    def zb_expr(f3: int, f7: int, a: str, b: str, op32: bool):
+        """
+        Zba and the Zbb logic/min/max register operations, the others are
+        left to the interpreter
+        """
+        shadd = f7 == ZB_F7.SHADD.value and f3 in (0b010, 0b100, 0b110)
+        if op32:
+            if shadd:
+                return f"(((({a} & 0x{MASK32:X}) << {f3>>1}) + {b})"\
+                    f" & 0x{MASK64:X})"
+            if f7 == ZB_F7.ADD_UW.value and f3 == 0b000:
+                return f"((({a} & 0x{MASK32:X}) + {b}) & 0x{MASK64:X})"
+            return None
+        if shadd:
+            return f"((({a} << {f3>>1}) + {b}) & 0x{MASK64:X})"
+        if f7 == ZB_F7.INV.value:
+            if f3 == OP_F3.AND.value:
+                return f"({a} & ~{b})"
+            elif f3 == OP_F3.OR.value:
+                return f"(({a} | ~{b}) & 0x{MASK64:X})"
+            elif f3 == OP_F3.XOR.value:
+                return f"(~({a} ^ {b}) & 0x{MASK64:X})"
+        elif f7 == ZB_F7.MINMAX_CLMUL.value:
+            if f3 == 0b100:
+                return f"({a} if ({a} ^ 0x{SIGN64:X}) < ({b} ^ 0x{SIGN64:X})"\
+                    f" else {b})"
+            elif f3 == 0b101:
+                return f"min({a}, {b})"
+            elif f3 == 0b110:
+                return f"({a} if ({a} ^ 0x{SIGN64:X}) > ({b} ^ 0x{SIGN64:X})"\
+                    f" else {b})"
+            elif f3 == 0b111:
+                return f"max({a}, {b})"
+        return None
+
+    @staticmethod
+    def branch_expr(f3: int, a: str, b: str):
+        def s(x):
+            return f"(({x} ^ 0x{SIGN64:X}) - 0x{SIGN64:X})"
+
+        if f3 == BR_F3.BEQ.value:
+            return f"{a} == {b}"
+        elif f3 == BR_F3.BNE.value:
+            return f"{a} != {b}"
+        elif f3 == BR_F3.BLT.value:
+            return f"{s(a)} < {s(b)}"
+        elif f3 == BR_F3.BGE.value:
+            return f"{s(a)} >= {s(b)}"
+        elif f3 == BR_F3.BLTU.value:
+            return f"{a} < {b}"
+        elif f3 == BR_F3.BGEU.value:
+            return f"{a} >= {b}"
+        return None
@@ -1,6 +1,4 @@
-import struct
-from math import ceil, log2
-from enum import Enum
+from math import log2
 from cpu_enums import *
 from typing import Dict, List, Tuple
 
@@ -208,6 +206,16 @@ class BlockReg(Reg):
             super().__setattr__(attr, value)  # allow normal attributes
             
 class RegFile:
+    """
+    Integer register file, the values live in the plain list `reg_file` that
+    the hart indexes directly. x0 is never written by the core (rd=x0 
+    handlers are replaced at decode), __setitem__ keeps it hardwired for 
+    any other user.
+    """
+    
+    __slots__ = ("n_regs", "n_regs_log2", "bus_size", "mask", "reg_file", 
+        "reg_names", "hex_fmt")
+    
     def __init__(self, n_regs, bus_size=32, reg_names:list[str]=None):
         self.n_regs = n_regs
         self.n_regs_log2 = int(log2(self.n_regs))
@@ -215,7 +223,7 @@ class RegFile:
         self.mask = (1<<self.bus_size)-1
         self.reg_file = [0]*self.n_regs
         self.reg_names = reg_names
-        self.hex_fmt = "%016x" if bus_size==64 else "%016x"
+        self.hex_fmt = "%016x" if bus_size==64 else "%08x"
         
         if not self.reg_names:
             self.reg_names = ["x%d"%i for i in range(self.n_regs)]
@@ -228,6 +236,15 @@ class RegFile:
     def __setitem__(self, key, value):
         if key>0:
             self.reg_file[key] = value & self.mask
+    
+    def snapshot(self) -> tuple:
+        """immutable copy of the register values"""
+        return tuple(self.reg_file)
+    
+    def restore(self, regs):
+        assert len(regs) == self.n_regs, f"expected {self.n_regs} registers"
+        # in place, run_blocks() keeps a reference to the list
+        self.reg_file[:] = [v & self.mask for v in regs]
 
     def show(self, stop=None):
         if not stop:
@@ -259,75 +276,151 @@ class RegFile:
                 dump_str+="%3s: %08x " % (name, self.reg_file[i])
         return dump_str
 
-class CsrReg(Reg):
+class CsrReg:
+    """
+    Name based view of one CSR, the value lives in the flat `regs` list of
+    the CsrFile at `index`. Each field, plus `all`, is a property with its 
+    shift and mask folded in, generated once per CSR definition by 
+    csr_view_class(). For the aliases (sstatus, frm, ...) index is the one of
+    the target CSR, rmask hides the bits the view can't see and the view 
+    value is the masked target shifted right by `shift`.
+    """
+    
+    __slots__ = ("regs", "addr", "index", "name", "nbits", "mask", "rmask", 
+        "shift", "wmask", "rw", "priv", "read_only")
     
     def __init__(self, 
+            regs:List[int], 
             addr:int, 
             name:str, 
             xlen:int, 
-            sections:Dict[str, List[int]]
+            wmask:int,
+            index:int = None,
+            rmask:int = -1,
+            shift:int = 0
         ):
-        super().__init__(xlen, 0)
-        
-        # sections be like {"name": [12,0], "name1": [20:13], ... }
-        # this will create n regslices referencing the csr bloks
-        # self.xlen = xlen
+        self.regs = regs
         self.addr = addr
+        self.index = addr if index is None else index
         self.name = name
-    
-        addr_reg = Reg(12, addr)
-        self.rw = addr_reg[11:10]
-        self.priv = Mode(addr_reg[9:8])
+        self.nbits = xlen
+        self.mask = (1<<xlen)-1
+        # the view is xlen bits wide from `shift` up in the target
+        self.rmask = rmask & (self.mask<<shift)
+        self.shift = shift
+        # WARL write mask applied to software (CSR instruction) writes
+        self.wmask = wmask & self.rmask
         
-        # self.reg = Reg(xlen)
-        sections['all'] = [xlen-1, 0]
-        self._blocks = {
-                blk : RegSlice(self, *bits) \
-                    for blk, bits in sections.items()
-            }
-        self.end_attr = True
+        self.rw = (addr>>10) & 0b11
+        self.priv = Mode((addr>>8) & 0b11)
+        self.read_only = self.rw == 0b11
+    
+    def __getitem__(self, key)->int:
+        value = (self.regs[self.index] & self.rmask)>>self.shift
+        if isinstance(key, slice):
+            msb = self.nbits-1 if key.start is None else key.start
+            lsb = 0 if key.stop is None else key.stop
+            return (value>>lsb) & ((1<<(msb-lsb+1))-1)
+        return (value>>key) & 1
+    
+    def __setitem__(self, key, value):
+        if isinstance(key, slice):
+            msb = self.nbits-1 if key.start is None else key.start
+            lsb = 0 if key.stop is None else key.stop
+        else:
+            msb = lsb = key
+        mask = ((1<<(msb-lsb+1))-1)<<lsb
+        # bits of the view to bits of the target
+        lsb += self.shift
+        mask = (mask<<self.shift) & self.rmask
+        self.regs[self.index] = (self.regs[self.index] & ~mask) | \
+            ((value<<lsb) & mask)
+    
+    def __str__(self):
+        return "%x"%((self.regs[self.index] & self.rmask)>>self.shift)
 
-    def __getattr__(self, attr):
-        if attr in self._blocks:
-            blk = self._blocks[attr]
-            if blk.nbits>15:
-                log.debug(f"CSR block read {self.name}.{attr}"\
-                    f" -> 0x{blk.val:0{int(self.nbits/4)}X}")
-            else:
-                log.debug(f"CSR block read {self.name}.{attr}"\
-                    f" -> 0b{blk.val:0{blk.nbits}b}")
-            return blk.val
-        raise AttributeError(f"{attr} not found")
 
-    def __setattr__(self, attr, value):
-        # If _blocks not yet created → just set attributes normally
-        if attr == "_blocks" or "_blocks" not in self.__dict__:
-            super().__setattr__(attr, value)
-        elif attr in self._blocks:
-            blk = self._blocks[attr]
-            blk.val = value
-            
-            if attr=='all':
-                log.debug(f"CSR write {self.name}"\
-                    f" -> 0x{blk.val:0{int(self.nbits/4)}X}")
-            else:
-                if blk.nbits>15:
-                    log.debug(f"CSR block write {self.name}.{attr}"\
-                        f" <- 0x{blk.val:0{int(self.nbits/4)}X}")
-                else:
-                    log.debug(f"CSR block write {self.name}.{attr}"\
-                        f" <- 0b{blk.val:0{blk.nbits}b}")
-        else:
-            super().__setattr__(attr, value)  # allow normal attributes
+def _field_property(csr_name:str, field:str, msb:int, lsb:int, trace:bool,
+        mask:int = None):
+    if mask is None:
+        mask = (1<<(msb-lsb+1))-1
+    clear = ~(mask<<lsb)
+    
+    def fget(self):
+        return (self.regs[self.index]>>lsb) & mask
+    
+    def fset(self, value):
+        regs = self.regs
+        regs[self.index] = (regs[self.index] & clear) | ((value & mask)<<lsb)
+    
+    if not trace:
+        return property(fget, fset)
+    
+    width = msb-lsb+1
+    fmt = f"0x{{:0{(width+3)//4}X}}" if width>15 else f"0b{{:0{width}b}}"
+    
+    def fget_traced(self):
+        value = fget(self)
+        log.debug(f"CSR block read {csr_name}.{field} -> {fmt.format(value)}")
+        return value
+    
+    def fset_traced(self, value):
+        fset(self, value)
+        log.debug(f"CSR block write {csr_name}.{field} <- "\
+            f"{fmt.format(fget(self))}")
+    
+    return property(fget_traced, fset_traced)
+
+_CSR_VIEW_CLASSES : Dict[Tuple, type] = {}
+
+def csr_view_class(
+        name:str, 
+        xlen:int, 
+        sections:Dict[str, List[int]], 
+        trace:bool = False,
+        rmask:int = -1,
+        shift:int = 0
+    ) -> type:
+    """CsrReg subclass with one property per field of the CSR, cached"""
+    
+    key = (name, xlen, tuple((f, tuple(b)) for f, b in sections.items()), 
+        trace, rmask, shift)
+    cls = _CSR_VIEW_CLASSES.get(key)
+    if cls is None:
+        # sections be like {"name": [12,0], "name1": [20], ... }
+        props = {"__slots__": ()}
+        for field, bits in sections.items():
+            msb, lsb = (bits[0]+shift, bits[-1]+shift)
+            props[field] = _field_property(name, field, msb, lsb, trace)
+        props["all"] = _field_property(name, "all", xlen-1, shift, trace, 
+            (rmask>>shift) & ((1<<xlen)-1))
+        cls = _CSR_VIEW_CLASSES[key] = type(f"Csr_{name}", (CsrReg,), props)
+    return cls
+
+def rv32_fields(name: str, sections: Dict[str, List[int]]
+        ) -> Dict[str, List[int]]:
+    """fields of a CSR on RV32, see CSR_RV32_FIELDS"""
+    fields = {field: [min(bits[0], 31)]+bits[1:] 
+        for field, bits in sections.items() if bits[-1] < 32}
+    fields.update(CSR_RV32_FIELDS.get(name, {}))
+    return fields
 
 #########################
 
 class CsrFile():
-    # TODO: implement attr get and set and log print on read. write is done
+    """
+    CSR values in a flat list indexed by CSR address. Each implemented CSR
+    also gets a CsrReg view as attribute, e.g. `csr.mstatus.MPP`, and by
+    address/name through `csr[key]`.
+    """
 
-    def __init__(self, ext_list: List[Ext]):     
+    def __init__(self, ext_list: List[Ext], trace: bool = False, 
+            xlen: int = 64):     
         
         self.ext_list = ext_list 
+        self.trace = trace
+        self.xlen = xlen
+        self.regs : List[int] = [0]*4096
         self.csr_map : Dict[int, CsrReg] = {}
         self.name_to_addr : Dict[str, int] = {}
             
@@ -335,6 +428,8 @@ class CsrFile():
             if   ext==Ext.M: self.add_csr_dict(CSR_M)
             elif ext==Ext.S: self.add_csr_dict(CSR_S)
             elif ext==Ext.U: self.add_csr_dict(CSR_U)
+            elif ext==Ext.F: self.add_csr_dict(CSR_F)
+            elif ext in (Ext.A, Ext.B, Ext.C, Ext.D): pass # no CSR
             else:
                 raise AssertionError(f"unknown extension {ext.name}")
         
@@ -343,9 +438,67 @@ class CsrFile():
         
         for name, value in csr_dict.items():
             addr, xlen, block_map = value
-            self.csr_map[addr] = CsrReg(addr, name, xlen, block_map)
+            alias = CSR_ALIAS.get(name)
+            warl = CSR_WARL.get(name, -1)
+            if self.xlen == 32:
+                xlen = min(xlen, 32)
+                block_map = rv32_fields(name, block_map)
+                alias = CSR_RV32_ALIAS.get(name, alias)
+                warl = CSR_RV32_WARL.get(name, warl)
+            index, rmask, shift = None, -1, 0
+            if alias is not None:
+                target, rmask, shift = alias
+                index = self.name_to_addr[target]
+            view_cls = csr_view_class(name, xlen, block_map, self.trace, 
+                rmask, shift)
+            csr_reg = view_cls(self.regs, addr, name, xlen, warl, index, 
+                rmask, shift)
+            self.csr_map[addr] = csr_reg
             self.name_to_addr[name] = addr
+            # plain instance attribute, no __getattr__ on access
+            self.__dict__[name] = csr_reg
+            # RV32: the upper half of a 64 bit counter is a CSR of its own
+            high = CSR_RV32_HIGH.get(name) if self.xlen == 32 else None
+            if high is not None:
+                high_name, high_addr = high
+                rmask = 0xffff_ffff<<32
+                high_cls = csr_view_class(high_name, 32, {}, self.trace, 
+                    rmask, 32)
+                csr_reg = high_cls(self.regs, high_addr, high_name, 32, -1, 
+                    csr_reg.index, rmask, 32)
+                self.csr_map[high_addr] = csr_reg
+                self.name_to_addr[high_name] = high_addr
+                self.__dict__[high_name] = csr_reg
+    
+    def read(self, addr: int) -> int:
+        """software read, what a CSR instruction sees"""
+        csr_reg = self.csr_map[addr]
+        return (self.regs[csr_reg.index] & csr_reg.rmask)>>csr_reg.shift
+    
+    def write(self, addr: int, value: int):
+        """software write, only the WARL writable bits change"""
+        csr_reg = self.csr_map[addr]
+        # satp with an unsupported MODE is not written at all (on RV32 both
+        # MODE values are supported)
+        if addr == 0x180 and value>>60 not in (SATP_BARE, SATP_SV39, SATP_SV48):
+            return
+        wmask = csr_reg.wmask
+        index = csr_reg.index
+        value <<= csr_reg.shift
+        self.regs[index] = (self.regs[index] & ~wmask) | (value & wmask)
+        if self.trace:
+            log.debug(f"CSR write {csr_reg.name}"\
+                    f" -> 0x{self.read(addr):0{int(csr_reg.nbits/4)}X}")
     
+    def snapshot(self) -> Dict[str, int]:
+        # the aliases are saved through their M-mode CSR
+        return {csr.name: self.regs[addr] for addr, csr in self.csr_map.items()
+            if csr.index == addr}
+    
+    def restore(self, values: Dict[str, int]):
+        """set the csr values by name, read only and WARL bits included"""
+        for name, value in values.items():
+            self.regs[self.name_to_addr[name]] = value
     
     def __getitem__(self, key):
         
@@ -362,16 +515,14 @@ class CsrFile():
         if type(key) == str:
             addr = self.name_to_addr[key]
         csr_reg = self.csr_map[addr]
-        csr_reg[:] = value&((1<<csr_reg.nbits)-1)
-        log.debug(f"CSR write {csr_reg.name}"\
-                f" -> 0x{csr_reg[:]:0{int(csr_reg.nbits/4)}X}")
+        csr_reg.all = value
     
-    def __getattr__(self, attr):
-        if attr in self.name_to_addr:
-            addr = self.name_to_addr[attr]
-            csr_reg = self.csr_map[addr]
-            return csr_reg
-        raise AttributeError(f"{attr} not found")
+    def __setattr__(self, attr, value):
+        # `csr.mhartid = x` writes the csr instead of replacing the view
+        if attr in self.__dict__.get("name_to_addr", ()):
+            self.__dict__[attr].all = value
+        else:
+            super().__setattr__(attr, value)
     
     def __repr__(self):
         max_len = max([len(i) for i in self.name_to_addr.keys()])
@@ -388,7 +539,7 @@ class CsrFile():
             
             out.append(f"* {y}0x{addr:03X} {g}{ul}{csr.name}{rst} "\
                 f"{gr}{bold}{'-'*(max_len-len(csr.name))}{gr}" \
-                f"{'rw' if csr.rw==3 else f"r-"}-{csr.priv.name}- "\
+                f"{'r-' if csr.read_only else 'rw'}-{csr.priv.name}- "\
                 f"{rst}0x{csr[:]:0{int(csr.nbits/4)}X}"
                 )
             
@@ -398,18 +549,10 @@ class CsrFile():
 
 
 def int_64(uint_64):
-    uint_64 = Reg(64, uint_64)
-    if uint_64[63]:
-        return int(uint_64[:] - (1<<64))
-    else:
-        return uint_64[:] 
+    return ((uint_64 & 0xffff_ffff_ffff_ffff) ^ (1<<63)) - (1<<63)
       
 def int_32(uint_32):
-    uint_32 = Reg(32, uint_32)
-    if uint_32[31]:
-        return int(uint_32[:] - (1<<32))
-    else:
-        return uint_32[:] 
+    return ((uint_32 & 0xffff_ffff) ^ (1<<31)) - (1<<31)
     
 def sign_extend(value, bits):
     sign_bit = 1 << (bits - 1)
@@ -423,3 +566,17 @@ def to_signed(num, nlen):
     if num & (1<<(nlen-1)):  # Check MSB for 32-bit
         num =  num - (1<<nlen)  # Subtract 2^32
     return num 
+
+def clmul(a, b):
+    """
+    carry-less product of two non negative ints: xor of a shifted copy of
+    the operand with more set bits for each set bit of the other one
+    """
+    if a.bit_count() < b.bit_count():
+        a, b = b, a
+    result = 0
+    while b:
+        low = b & -b
+        result ^= a * low # a << index of the bit
+        b ^= low
+    return result